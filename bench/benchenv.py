@@ -0,0 +1,16 @@
+# What the bench scripts share: importing this puts the repo on sys.path, and configure() sets up the
+# environment makenight reads at import time, so call it before importing makenight.
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+
+# Twilio is replaced by faketwilio (with no latency unless FAKE_TWILIO is already set), the other
+# credentials get dummy values, and Mongo is the named database on a local mongod. Scripts that drop
+# their database rely on it being overwritten rather than defaulted, so it's never MONGOHQ_URL's.
+def configure(database):
+	os.environ.setdefault('FAKE_TWILIO', '0')
+	for key in ['ACCOUNT_SID', 'AUTH_TOKEN', 'TWILIO', 'ME', 'PW']:
+		os.environ.setdefault(key, 'bench')
+	os.environ['MONGOHQ_URL'] = 'mongodb://localhost:27017/' + database
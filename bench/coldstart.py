@@ -0,0 +1,62 @@
+# Measures how long a freshly started app takes to answer its first texts and leaderboard load,
+# with and without a snapshot to warm up from.
+#
+#   python bench/coldstart.py [players] [texts]
+#
+# Each measurement is a new process, so nothing is cached but what the snapshot restores.
+# Uses (and drops) the makenightcoldstart database on a local mongod; Twilio is replaced by faketwilio.
+import json
+import os
+import subprocess
+import sys
+import time
+import benchenv
+
+def prepare(playerCount):
+	benchenv.configure('makenightcoldstart')
+	import makenight
+	import listprep
+	makenight.mongoclient.drop_database(makenight.databasename)
+	makenight.ensureIndexes()
+	game = listprep.makeGame(" ".join("word%d" % i for i in range(600)), 6, 100)
+	makenight.games.insert_one(game)
+	records = [makenight.newPlayerRecord(str(100 + i), "+1555%07d" % i, game["wordlists"][i % 100]) for i in range(playerCount)]
+	for i, record in enumerate(records):
+		record["points"] = i % 50
+	makenight.players.insert_many(records)
+	makenight.takeSnapshot()
+
+def measure(playerCount, texts):
+	start = time.time()
+	from gevent import monkey
+	monkey.patch_all()
+	benchenv.configure('makenightcoldstart')
+	import makenight
+	client = makenight.app.test_client()
+	imported = time.time()
+	client.post('/twilio', data={'From': "+1555%07d" % 0, 'Body': "101 word1"})
+	first = time.time()
+	for i in range(1, texts):
+		client.post('/twilio', data={'From': "+1555%07d" % (i * 7 % playerCount), 'Body': "%d word%d" % (100 + i % playerCount, i % 600)})
+	client.get('/leaderboard')
+	done = time.time()
+	print "result " + json.dumps({"startup ms": (imported - start) * 1000, "first text ms": (first - start) * 1000,
+		"all texts and leaderboard ms": (done - start) * 1000, "snapshot players": makenight.startupStats["snapshotPlayers"]})
+
+def run(mode, playerCount, texts, environment):
+	output = subprocess.Popen([sys.executable, __file__, mode, str(playerCount), str(texts)], stdout=subprocess.PIPE, env=environment).communicate()[0]
+	lines = [line for line in output.split("\n") if line.startswith("result ")]
+	return json.loads(lines[-1][len("result "):]) if lines else None
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--prepare":
+		prepare(int(sys.argv[2]))
+	elif len(sys.argv) > 1 and sys.argv[1] == "--measure":
+		measure(int(sys.argv[2]), int(sys.argv[3]))
+	else:
+		playerCount = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+		texts = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+		subprocess.check_call([sys.executable, __file__, "--prepare", str(playerCount)])
+		for label, interval in [("without snapshot", "0"), ("with snapshot", "60")]:
+			environment = dict(os.environ, SNAPSHOT_INTERVAL=interval)
+			print label + ": " + json.dumps(run("--measure", playerCount, texts, environment), sort_keys=True)
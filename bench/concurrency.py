@@ -0,0 +1,55 @@
+# Fires the same friend and enemy reports from many greenlets at once against a local mongod,
+# and checks that each one was scored exactly once.
+#
+#   python bench/concurrency.py [parallel reports]
+#
+# Uses (and drops) the makenightconcurrency database; Twilio is replaced by faketwilio.
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import gevent
+import benchenv
+
+parallel = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+benchenv.configure('makenightconcurrency')
+import makenight
+
+makenight.mongoclient.drop_database(makenight.databasename)
+makenight.ensureIndexes()	# the unique index on reports is what stops duplicates
+makenight.games.insert({"status": "active", "wordlists": [["apple", "pear"], ["stone", "river"]], "spuriousReports": []})
+for agentNumber, words in [("101", ["apple", "pear"]), ("102", ["apple", "pear"]), ("201", ["stone", "river"])]:
+	makenight.players.insert(makenight.newPlayerRecord(agentNumber, "+1555000"+agentNumber, words))
+
+failures = []
+
+def expect(what, actual, expected):
+	if actual != expected:
+		failures.append(what)
+	print "%-40s %-10s (expected %s)" % (what, actual, expected)
+
+def fire(report, *args):
+	# every greenlet gets past the cached duplicate check before any of them has written anything
+	jobs = [gevent.spawn(report, *args) for i in range(parallel)]
+	gevent.joinall(jobs)
+	return len([job for job in jobs if job.value])
+
+def points(agentNumber):
+	return makenight.players.find_one({"agentNumber": agentNumber})["points"]
+
+expect("friend reports scored", fire(makenight.reportFriend, "101", "102"), 1)
+expect("enemy reports scored", fire(makenight.reportEnemy, "101", "201", "stone"), 1)
+expect("points for 101", points("101"), 13)
+expect("points for 102", points("102"), 10)
+expect("points for 201", points("201"), -2)
+expect("contacts counted for 101", makenight.players.find_one({"agentNumber": "101"})["contacts"], 1)
+expect("contact reports recorded", makenight.reports.find({"kind": "contact"}).count(), 1)
+expect("reverse friend report scored", fire(makenight.reportFriend, "102", "101"), 0)
+expect("cached points for 101", makenight.getPlayer("101")["points"], 13)
+
+makenight.outbox.join()
+makenight.flushTranscript()
+if failures:
+	print "FAILED: " + ", ".join(failures)
+	sys.exit(1)
+print "ok"
@@ -0,0 +1,74 @@
+# Plays a burst of reports against a local mongod and counts what a single leaderboard client would
+# be sent over the socket: one frame per message to everyone (as it used to be) against the coalesced
+# per-room frames emitMessage sends now.
+#
+#   python bench/fanout.py [reports] [seconds to spread them over]
+#
+# Uses (and drops) the makenightfanout database; Twilio is replaced by faketwilio. Set EMIT_INTERVAL
+# to try other tick lengths.
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import random
+import sys
+import time
+import gevent
+import benchenv
+
+reportCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+benchenv.configure('makenightfanout')
+import makenight
+import listprep
+
+makenight.mongoclient.drop_database(makenight.databasename)
+makenight.ensureIndexes()
+game = listprep.makeGame(" ".join("word%d" % i for i in range(600)), 6, 20)
+makenight.games.insert_one(game)
+agents = [str(100 + i) for i in range(200)]
+makenight.players.insert_many([makenight.newPlayerRecord(agentNumber, "+1555000" + agentNumber, game["wordlists"][i % 20]) for i, agentNumber in enumerate(agents)])
+makenight.invalidateCache()
+
+# what a client got before rooms and ticks: every message, as its own frame
+legacy = {"frames": 0, "bytes": 0}
+emitMessage = makenight.emitMessage
+def countingEmitMessage(data):
+	legacy["frames"] += 1
+	legacy["bytes"] += len(json.dumps(data))
+	emitMessage(data)
+makenight.emitMessage = countingEmitMessage
+
+# and what the leaderboard room gets now
+leaderboard = {"frames": 0, "bytes": 0}
+emit = makenight.socketio.emit
+def countingEmit(event, frame, room=None, **kwargs):
+	if room == "leaderboard":
+		leaderboard["frames"] += 1
+		leaderboard["bytes"] += len(json.dumps(frame))
+	emit(event, frame, room=room, **kwargs)
+makenight.socketio.emit = countingEmit
+
+def report(i):
+	reporter, other = random.sample(agents, 2)
+	if i % 3 == 0:
+		makenight.reportFriend(reporter, other)
+	else:
+		makenight.reportEnemy(reporter, other, random.choice(game["wordlists"][agents.index(other) % 20] + ["decoy%d" % (i % 50)]))
+
+start = time.time()
+jobs = []
+for i in range(reportCount):
+	jobs.append(gevent.spawn(report, i))
+	gevent.sleep(duration / reportCount)
+gevent.joinall(jobs)
+makenight.flushTranscript()
+makenight.flushEmits()
+elapsed = time.time() - start
+makenight.outbox.join()
+
+print "%d reports in %.1fs, EMIT_INTERVAL %s" % (reportCount, elapsed, makenight.emitInterval)
+print "%-28s %12s %14s" % ("per leaderboard client", "frames/s", "bytes/s")
+print "%-28s %12.1f %14.0f" % ("every message to everyone", legacy["frames"] / elapsed, legacy["bytes"] / elapsed)
+print "%-28s %12.1f %14.0f" % ("coalesced, leaderboard room", leaderboard["frames"] / elapsed, leaderboard["bytes"] / elapsed)
+print "messages coalesced away: %d of %d" % (makenight.emitStats["coalesced"], makenight.emitStats["events"])
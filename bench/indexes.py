@@ -0,0 +1,58 @@
+# Compares report latency with and without the Mongo indexes from ensureIndexes, at 1k and 10k players.
+# The player cache is emptied before every report so each one pays for its Mongo lookups, the way
+# the first report from each agent does after a restart.
+#
+#   python bench/indexes.py [reports per run]
+#
+# Uses (and drops) the makenightindexes database on a local mongod; Twilio is replaced by faketwilio.
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import time
+import random
+import benchenv
+
+reports = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+os.environ.setdefault('SLOW_QUERY_MS', '100000')
+benchenv.configure('makenightindexes')
+import makenight
+import listprep
+
+def setUp(playerCount):
+	makenight.mongoclient.drop_database(makenight.databasename)
+	words = " ".join("word%d" % i for i in range(600))
+	wordlists = listprep.makeLists(words, 6, 100)
+	makenight.games.insert({"status": "active", "wordlists": wordlists, "spuriousReports": []})
+	makenight.players.insert_many([makenight.newPlayerRecord(str(1000 + i), "+1555%07d" % i, wordlists[i % len(wordlists)]) for i in range(playerCount)])
+	makenight.invalidateCache()
+	return wordlists
+
+def run(playerCount, wordlists):
+	timings = []
+	for i in range(reports):
+		reporter = random.randrange(playerCount)
+		suspect = random.randrange(playerCount)
+		makenight.cache["byAgent"].clear()
+		makenight.cache["byPhone"].clear()
+		start = time.time()
+		makenight.gameLogic("+1555%07d" % reporter, "%d %s" % (1000 + suspect, random.choice(wordlists[suspect % len(wordlists)])))
+		timings.append(time.time() - start)
+	timings.sort()
+	return timings[len(timings) / 2] * 1000, timings[int(len(timings) * 0.99)] * 1000
+
+print "%8s %10s %10s %10s" % ("players", "indexes", "p50 ms", "p99 ms")
+for playerCount in [1000, 10000]:
+	wordlists = setUp(playerCount)
+	for indexed in [False, True]:
+		if indexed:
+			makenight.ensureIndexes()
+		else:
+			makenight.players.drop_indexes()
+			makenight.games.drop_indexes()
+		p50, p99 = run(playerCount, wordlists)
+		print "%8d %10s %10.2f %10.2f" % (playerCount, indexed, p50, p99)
+
+makenight.outbox.join()
+makenight.flushTranscript()
@@ -0,0 +1,146 @@
+# Replays synthetic SMS traffic against the /twilio webhook and reports latency, throughput and
+# Mongo commands per message.
+#
+#   python bench/loadtest.py --agents 300 --messages 3000 --concurrency 20 --save before.json
+#   python bench/loadtest.py --agents 300 --messages 3000 --concurrency 20 --compare before.json
+#
+# The app runs in-process behind Flask's test client, with gevent doing the concurrency the way the
+# single GeventWebSocketWorker in the Procfile would. Twilio is replaced by faketwilio, and Mongo is
+# a local mongod (the makenightload database is dropped first). Traffic is generated from --seed, so
+# two runs with the same arguments send exactly the same messages and their numbers can be compared.
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import random
+import time
+from gevent.pool import Pool
+from pymongo import monitoring
+import benchenv
+
+parser = argparse.ArgumentParser(description="Replay synthetic SMS traffic against /twilio")
+parser.add_argument("--agents", type=int, default=200)
+parser.add_argument("--messages", type=int, default=2000, help="game messages after everyone has joined")
+parser.add_argument("--concurrency", type=int, default=20, help="webhook requests in flight at once")
+parser.add_argument("--teams", type=int, default=10)
+parser.add_argument("--words", type=int, default=6, help="words per wordlist")
+parser.add_argument("--leaving", type=int, default=10, help="agents who send \"leaving\" at the end")
+parser.add_argument("--twilio-latency", default="0", help="seconds each fake Twilio send takes")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--save", help="write the results to this JSON file")
+parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+args = parser.parse_args()
+
+os.environ['FAKE_TWILIO'] = args.twilio_latency
+benchenv.configure('makenightload')
+
+class CommandCounter(monitoring.CommandListener):
+	def __init__(self):
+		self.count = 0
+
+	def started(self, event):
+		self.count += 1
+
+	def succeeded(self, event):
+		pass
+
+	def failed(self, event):
+		pass
+
+# has to be registered before makenight creates its MongoClient
+mongoCommands = CommandCounter()
+monitoring.register(mongoCommands)
+
+import makenight
+import listprep
+
+random.seed(args.seed)
+makenight.mongoclient.drop_database(makenight.databasename)
+makenight.ensureIndexes()
+wordpool = " ".join("word%d" % i for i in range(args.teams * args.words))
+makenight.games.insert({"status": "active", "wordlists": listprep.makeLists(wordpool, args.words, args.teams), "spuriousReports": []})
+makenight.invalidateCache()
+client = makenight.app.test_client()
+
+agents = [(str(100 + i), "+1555%07d" % i) for i in range(args.agents)]
+latencies = {}
+
+def send(kind, phoneNumber, body):
+	start = time.time()
+	response = client.post('/twilio', data={'From': phoneNumber, 'Body': body})
+	latencies.setdefault(kind, []).append(time.time() - start)
+	if response.status_code != 204:
+		latencies.setdefault("failed", []).append(0)
+
+def replay(messages):
+	pool = Pool(args.concurrency)
+	opsBefore = mongoCommands.count
+	start = time.time()
+	count = 0
+	for kind, phoneNumber, body in messages:
+		pool.spawn(send, kind, phoneNumber, body)
+		count += 1
+	pool.join()
+	elapsed = time.time() - start
+	# count the work the webhook handed off, too
+	makenight.outbox.join()
+	makenight.flushTranscript()
+	return count, elapsed, (mongoCommands.count - opsBefore) / float(max(count, 1))
+
+def gameTraffic():
+	teams = {}
+	for agentNumber, phoneNumber in agents:
+		teams.setdefault(makenight.getTeam(makenight.getPlayer(agentNumber)), []).append(agentNumber)
+	teamOf = dict((agentNumber, team) for team, members in teams.items() for agentNumber in members)
+	kinds = ["friend"] * 30 + ["wrongfriend"] * 10 + ["enemy"] * 35 + ["spurious"] * 15 + ["parseerror"] * 10
+	for i in range(args.messages):
+		agentNumber, phoneNumber = random.choice(agents)
+		team = teamOf[agentNumber]
+		other = random.choice(agents)[0]
+		kind = random.choice(kinds)
+		if kind == "friend":
+			yield kind, phoneNumber, random.choice(teams[team])
+		elif kind == "wrongfriend":
+			yield kind, phoneNumber, other
+		elif kind == "enemy":
+			yield kind, phoneNumber, other + " " + random.choice(list(makenight.cache["teamWords"][teamOf[other]]))
+		elif kind == "spurious":
+			yield kind, phoneNumber, other + " " + random.choice(["pineapple", "umbrella", "hello", "yes", "party"])
+		else:
+			yield kind, phoneNumber, random.choice(["what do I do", "???", "help", "hi there"])
+	for agentNumber, phoneNumber in agents[:args.leaving]:
+		yield "leaving", phoneNumber, "leaving"
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(int(len(values) * fraction), len(values) - 1)] * 1000
+
+joins, joinTime, joinOps = replay(("join", phoneNumber, agentNumber) for agentNumber, phoneNumber in agents)
+messages, gameTime, gameOps = replay(gameTraffic())
+
+allLatencies = [value for kind, values in latencies.items() if kind not in ["join", "failed"] for value in values]
+results = {
+	"agents": args.agents, "messages": messages, "concurrency": args.concurrency, "seed": args.seed,
+	"failed": len(latencies.get("failed", [])),
+	"join messages/s": joins / joinTime,
+	"join mongo ops/message": joinOps,
+	"messages/s": messages / gameTime,
+	"p50 ms": percentile(allLatencies, 0.5),
+	"p99 ms": percentile(allLatencies, 0.99),
+	"mongo ops/message": gameOps,
+}
+for kind, values in latencies.items():
+	if kind != "failed":
+		results[kind + " p50 ms"] = percentile(values, 0.5)
+		results[kind + " p99 ms"] = percentile(values, 0.99)
+
+previous = json.load(open(args.compare)) if args.compare else {}
+for key in sorted(results):
+	line = "%-28s %12.2f" % (key, results[key])
+	if key in previous and previous[key]:
+		line += "   was %12.2f  (%+.1f%%)" % (previous[key], 100.0 * (results[key] - previous[key]) / previous[key])
+	print line
+if args.save:
+	json.dump(results, open(args.save, "w"), indent=1, sort_keys=True)
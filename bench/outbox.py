@@ -0,0 +1,32 @@
+# Offline throughput benchmark for the outbound SMS queue.
+# Twilio is replaced by faketwilio; transcripts still go to Mongo, so a local mongod has to be running.
+#
+#   python bench/outbox.py [messages] [workers] [twilio latency in seconds]
+#
+# With the default SENDS_PER_SECOND (no limit) the worker pool is what gets measured. Set it
+# yourself to see the per-number rate limit in action.
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import time
+import benchenv
+
+messages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+os.environ['OUTBOX_WORKERS'] = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('OUTBOX_WORKERS', '8')
+os.environ['FAKE_TWILIO'] = sys.argv[3] if len(sys.argv) > 3 else os.environ.get('FAKE_TWILIO', '0.2')
+benchenv.configure('makenightbench')
+import makenight
+
+start = time.time()
+for i in range(messages):
+	makenight.queueMessage("+1555000%04d" % i, "benchmark message %d" % i, makenight.twilioNumbers[0], str(100 + i % 900))
+queued = time.time()
+makenight.outbox.join()
+done = time.time()
+
+print "%d messages, %s workers, %ss simulated Twilio latency" % (messages, os.environ['OUTBOX_WORKERS'], os.environ['FAKE_TWILIO'])
+print "time to queue: %.3fs" % (queued - start)
+print "time to drain: %.3fs (%.1f messages/s)" % (done - start, messages / (done - start))
+print "stats: %s" % makenight.outboxStats
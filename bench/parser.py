@@ -0,0 +1,90 @@
+# coding=utf-8
+# Checks smsparser against the parsing gameLogic and newAgent used to do inline, on a corpus of
+# real-world message shapes plus random fuzz, and times both.
+#
+#   python bench/parser.py [fuzz messages] [timing rounds]
+#
+# Exits non-zero if the two ever disagree. Needs nothing but the standard library.
+import random
+import re
+import string
+import sys
+import timeit
+import benchenv
+import smsparser
+
+fuzzCount = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+# The parsing as it was written in gameLogic and newAgent before smsparser, word for word
+def isAgentNumber(word):
+	return re.match("\d{2,3}", word)
+
+def legacyJoin(rawcontent):
+	content = re.split('\W+', rawcontent.lower())
+	agentNumber = content[0]
+	if not isAgentNumber(agentNumber):
+		return ("Invalid", "notanagentnumber")
+	return ("Join", agentNumber)
+
+def legacyParse(rawcontent):
+	if re.match("leaving", rawcontent.lower()):
+		return ("Leave",)
+	content = re.split('\W+', rawcontent.strip().lower().strip(string.punctuation))
+	if len(content) == 1:
+		if isAgentNumber(content[0]):
+			return ("Friend", content[0])
+		return ("Invalid", "unparseable")
+	accusee = None
+	for i in range(len(content)):
+		if isAgentNumber(content[i]):
+			accusee = content.pop(i)
+			break
+	if accusee:
+		if len(content) == 1:
+			return ("Enemy", accusee, content[0])
+		return ("Invalid", "toomanywords")
+	return ("Invalid", "unparseable")
+
+def asTuple(command):
+	return (type(command).__name__,) + tuple(command)
+
+# Shapes agents actually send
+corpus = [
+	u"101", u"  101 ", u"101.", u"#101", u"Agent 101", u"agent101", u"1O1", u"1", u"12", u"1234", u"007",
+	u"101 apple", u"apple 101", u"101, apple!", u"101 - Apple", u"APPLE 101", u"101 apple pear", u"101 101",
+	u"101apple", u"101 the apple", u"apple", u"apple pear", u"hi", u"?", u"!!!", u"", u"   ", u"\n101\n",
+	u"leaving", u"Leaving", u"LEAVING now", u"leaving.", u" leaving", u"I'm leaving", u"leavingsoon",
+	u"101 café", u"café 101", u"101 crème brûlée", u"101 😀", u"101\tapple", u"101 apple .", u". 101 apple",
+	u"202 don't", u"202 it's", u"Hi HQ, 303 said banana", u"303 banana???", u"...303...", u"303 _", u"_303",
+	u"What do I do?", u"help", u"score", u"12 34", u"99 bottles", u"101 apple\n", u"101,apple", u"101;apple",
+]
+
+alphabet = u"0123456789" * 3 + u"abcdefghijklmnopqrstuvwxyz" + u"ABCXYZ" + u"     " + u".,!?'-_#\t\n" + u"éü😀" + u"leaving "
+def fuzz():
+	return u"".join(random.choice(alphabet) for i in range(random.randint(0, 20)))
+
+random.seed(1)
+messages = corpus + [fuzz() for i in range(fuzzCount)]
+
+mismatches = 0
+for message in messages:
+	for legacy, current in [(legacyParse, smsparser.parse), (legacyJoin, smsparser.parseJoin)]:
+		if legacy(message) != asTuple(current(message)):
+			mismatches += 1
+			if mismatches <= 20:
+				print "MISMATCH %r: was %r, now %r" % (message, legacy(message), asTuple(current(message)))
+print "%d messages, %d mismatches" % (len(messages), mismatches)
+
+def timeParser(parse, join):
+	def run():
+		for message in messages:
+			parse(message)
+			join(message)
+	return min(timeit.repeat(run, number=1, repeat=rounds))
+
+legacyTime = timeParser(legacyParse, legacyJoin)
+currentTime = timeParser(smsparser.parse, smsparser.parseJoin)
+print "legacy:    %.2f us/message" % (legacyTime / len(messages) * 1e6)
+print "smsparser: %.2f us/message (%.2fx)" % (currentTime / len(messages) * 1e6, legacyTime / currentTime)
+sys.exit(1 if mismatches or currentTime >= legacyTime else 0)
@@ -0,0 +1,44 @@
+# Compares how many BSON bytes a player record takes, and how many bytes each scored report sends to
+# Mongo, with the report lists kept on the player (as they used to be) and with the reports collection.
+# The player record is what every cache miss, warm-up and snapshot reads, so it's the number that
+# grows over a game.
+#
+#   python bench/recordsize.py
+#
+# Needs pymongo (for bson) but no database.
+import bson
+
+words = ["word%d" % i for i in range(6)]
+
+def legacyRecord(contacts, enemyReports, intercepted, spurious):
+	return {"agentNumber": "101", "phoneNumber": "+15550000101", "status": "active", "words": words,
+		"successfulContacts": [str(200 + i) for i in range(contacts)],
+		"interceptedTransmits": ["%d word%d" % (300 + i, i) for i in range(intercepted)],
+		"reportedEnemyCodes": ["%d word%d" % (400 + i, i) for i in range(enemyReports)],
+		"spuriousReports": ["%d word%d" % (500 + i, i) for i in range(spurious)],
+		"points": 10 * contacts + 3 * enemyReports - 2 * intercepted - 2 * spurious}
+
+# as makenight.newPlayerRecord makes them, after the same activity
+def compactRecord(contacts, enemyReports, intercepted, spurious):
+	return {"agentNumber": "101", "phoneNumber": "+15550000101", "status": "active", "words": words,
+		"contacts": contacts, "enemyReports": enemyReports, "intercepted": intercepted, "spurious": spurious,
+		"points": 10 * contacts + 3 * enemyReports - 2 * intercepted - 2 * spurious,
+		"scoreVersion": contacts + enemyReports + intercepted + spurious}
+
+def size(*documents):
+	return sum(len(bson.BSON.encode(document)) for document in documents)
+
+# What one good enemy report sent: the conditional $addToSet update, then the update for the enemy
+legacyReport = size({"agentNumber": "101", "reportedEnemyCodes": {"$ne": "401 word1"}},
+	{"$addToSet": {"reportedEnemyCodes": "401 word1"}, "$inc": {"points": 3}},
+	{"agentNumber": "401"}, {"$push": {"interceptedTransmits": "101 word1"}, "$inc": {"points": -2}})
+# and what it sends now: the report insert, then an update for each agent
+compactReport = size({"game": bson.ObjectId(), "reporter": "101", "target": "401", "word": "word1", "kind": "enemy"},
+	{"agentNumber": "101"}, {"$inc": {"enemyReports": 1, "points": 3, "scoreVersion": 1}},
+	{"agentNumber": "401"}, {"$inc": {"intercepted": 1, "points": -2, "scoreVersion": 1}})
+
+print "bytes sent per good enemy report: %d before, %d after" % (legacyReport, compactReport)
+print
+print "%-46s %10s %10s" % ("reports (contacts/enemy/intercepted/spurious)", "before", "after")
+for activity in [(0, 0, 0, 0), (5, 5, 3, 2), (20, 20, 10, 10), (100, 100, 50, 50)]:
+	print "%-46s %10d %10d" % ("%d/%d/%d/%d" % activity, size(legacyRecord(*activity)), size(compactRecord(*activity)))
@@ -0,0 +1,33 @@
+# Times listprep.makeLists against the pop-from-the-middle version it replaced, on big word pools.
+#
+#   python bench/wordlists.py
+#
+# Needs nothing but the standard library.
+import random
+import re
+import timeit
+import benchenv
+import listprep
+
+# makeLists as it used to be
+def legacyMakeLists(inputString, groupSize, numberOfGroups):
+	inputList = re.split('\W+', inputString)
+	outputList = []
+	for i in range(numberOfGroups):
+		groupList = []
+		for j in range(groupSize):
+			groupList.append(inputList.pop(random.randint(0,len(inputList)-1)))
+		outputList.append(groupList)
+	return outputList
+
+print "%8s %8s %12s %12s" % ("pool", "lists", "legacy ms", "makeLists ms")
+for poolSize in [10000, 50000, 200000]:
+	pool = " ".join("word%d" % i for i in range(poolSize))
+	groupSize = 6
+	numberOfGroups = poolSize / groupSize
+	lists = listprep.makeLists(pool, groupSize, numberOfGroups)
+	words = [word for wordlist in lists for word in wordlist]
+	assert len(words) == len(set(words)) == groupSize * numberOfGroups
+	legacy = min(timeit.repeat(lambda: legacyMakeLists(pool, groupSize, numberOfGroups), number=1, repeat=3))
+	current = min(timeit.repeat(lambda: listprep.makeLists(pool, groupSize, numberOfGroups), number=1, repeat=3))
+	print "%8d %8d %12.1f %12.1f" % (poolSize, numberOfGroups, legacy * 1000, current * 1000)
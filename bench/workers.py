@@ -0,0 +1,94 @@
+# Runs several app processes against the same Redis and mongod, each with its own socket client in the
+# leaderboard room, and checks that an emit and a score change made in one process reach every
+# process's client, and that every process's leaderboard ranking picks up the change.
+#
+#   python bench/workers.py [workers] [redis URL]
+#
+# Needs redis-server and mongod running locally. Uses (and drops) the makenightworkers database.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import benchenv
+
+goFile = os.path.join(tempfile.gettempdir(), "makenight-workers-go")
+
+def configure(redisURL):
+	os.environ['SOCKETIO_QUEUE'] = redisURL
+	benchenv.configure('makenightworkers')
+
+# One app process: connect a socket client, wait for the go signal, have worker 0 make the changes,
+# then print what this process saw as a line of JSON.
+def worker(index, redisURL):
+	from gevent import monkey
+	monkey.patch_all()
+	import gevent
+	configure(redisURL)
+	import makenight
+	import flask_socketio.test_client
+
+	# The test client refuses to run on a message queue, though all it uses the manager for is rooms,
+	# which the queue's manager keeps like any other. So hide the queue from that check, and mark the
+	# manager initialized so that connecting doesn't start a second Redis listener.
+	flask_socketio.test_client.PubSubManager = type("NoQueue", (object,), {})
+	makenight.socketio.server.manager_initialized = True
+	client = makenight.socketio.test_client(makenight.app)
+	client.emit('join', 'leaderboard')
+	makenight.getRanking()
+	print "ready"
+	sys.stdout.flush()
+	while not os.path.exists(goFile):
+		gevent.sleep(0.05)
+	if index == 0:
+		makenight.emitMessage({"type": "spurious", "word": "workerbench"})
+		makenight.awardPoints("101", 5)
+	gevent.sleep(2)
+	# (for "message" events the test client's args are the payload itself, here a frame of events)
+	received = [data for message in client.get_received() if message["name"] == "message" for data in message["args"]["events"]]
+	print "result " + json.dumps({
+		"spurious": any(data["type"] == "spurious" and data.get("word") == "workerbench" for data in received),
+		"rankchange": any(data["type"] == "rankchanges" and "101" in [change["agentNumber"] for change in data["changes"]] for data in received),
+		"points": makenight.cache["rankedPoints"].get("101"),
+	})
+
+def main(workers, redisURL):
+	configure(redisURL)
+	import pymongo
+	import collectionnames
+	database = pymongo.MongoClient(os.environ['MONGOHQ_URL'])["makenightworkers"]
+	database.client.drop_database("makenightworkers")
+	database[collectionnames.games].insert_one({"status": "active", "wordlists": [["apple", "pear"]], "spuriousReports": []})
+	database[collectionnames.players].insert_one({"agentNumber": "101", "phoneNumber": "+15550000101", "status": "active", "words": ["apple", "pear"],
+		"contacts": 0, "enemyReports": 0, "intercepted": 0, "spurious": 0, "points": 0})
+	if os.path.exists(goFile):
+		os.remove(goFile)
+
+	processes = [subprocess.Popen([sys.executable, __file__, "--worker", str(i), redisURL], stdout=subprocess.PIPE) for i in range(workers)]
+	# (the app prints its transcript to stdout too, so look for our own lines)
+	for process in processes:
+		line = process.stdout.readline()
+		while line and line.strip() != "ready":
+			line = process.stdout.readline()
+		if not line:
+			print "a worker didn't start"
+			sys.exit(1)
+	open(goFile, "w").close()
+	results = []
+	for process in processes:
+		output = process.communicate()[0]
+		results.append(json.loads([line for line in output.split("\n") if line.startswith("result ")][-1][len("result "):]))
+	os.remove(goFile)
+
+	failed = False
+	for i, result in enumerate(results):
+		ok = result["spurious"] and result["rankchange"] and result["points"] == 5
+		failed = failed or not ok
+		print "worker %d: %s %s" % (i, "ok" if ok else "FAILED", result)
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+		worker(int(sys.argv[2]), sys.argv[3])
+	else:
+		main(int(sys.argv[1]) if len(sys.argv) > 1 else 3, sys.argv[2] if len(sys.argv) > 2 else "redis://localhost:6379/0")
@@ -0,0 +1,7 @@
+# Names of the Mongo collections the game is kept in, for makenight.py and the tools that read them
+players = "players"
+transcript = "transcript"
+games = "games"
+inbound = "inbound"
+snapshots = "snapshots"
+reports = "reports"
@@ -0,0 +1,126 @@
+# Exports a game's transcript and players to Parquet files, so it can be analysed (see gamestats.py)
+# without going back to the production database.
+#
+#   python exportgame.py archive/            exports the most recent game
+#   python exportgame.py archive/ --game ID  exports the game with that _id
+#
+# Reads MONGOHQ_URL. A game is taken to run from its games document's creation until the next game's,
+# and the transcript lines and players created in that window are the ones exported:
+#
+#   archive/transcript/tag=<tag>/part-0.parquet   one directory per transcript tag
+#   archive/players.parquet
+#
+# Transcript lines keep their time, tag and content, plus the agent, target and word picked out of the
+# content for the tags that name them. Phone numbers are left out.
+#
+# Needs pyarrow, which the app itself doesn't, so it isn't in requirements.txt:
+# pip install pyarrow==0.16.0 pytz (0.16.0 is the last release for Python 2, and needs pytz there to
+# read timestamps back).
+import argparse
+import os
+import re
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ASCENDING
+import pyarrow
+import pyarrow.parquet
+import collectionnames
+
+parser = argparse.ArgumentParser(description="Export a game to Parquet files")
+parser.add_argument("directory")
+parser.add_argument("--game", help="_id of the game to export (default: the most recent)")
+parser.add_argument("--batch", type=int, default=5000, help="rows per cursor batch and per Parquet row group")
+args = parser.parse_args()
+
+# What each tag's content says, as makenight.py writes it
+patterns = {
+	"incoming": r"Agent (?P<agent>\d+) sent: ",
+	"newagent": r"New agent: (?P<agent>\d+)",
+	"agentretired": r"Agent retired: (?P<agent>\d+)",
+	"parsererror": r"Agent (?P<agent>\d+)'s message",
+	"successfulcontact": r"Agents (?P<agent>\d+) and (?P<target>\d+) successfully",
+	"incorrectcontact": r"Agent (?P<agent>\d+) incorrectly reported friendly contact with Agent (?P<target>\d+)",
+	"interceptedtransmit": r"Agent (?P<agent>\d+) caught Agent (?P<target>\d+) transmitting code \"(?P<word>.*)\"",
+	"interceptedfriendlytransmit": r"Agent (?P<agent>\d+) reported Agent (?P<target>\d+) for code \"(?P<word>.*)\" but",
+	"spuriousreport": r"Agent (?P<agent>\d+) spuriously reported Agent (?P<target>\d+) for the code \"(?P<word>.*)\"",
+	"sentmessage": r"Sent message to (?P<agent>\d+):",
+	}
+patterns = dict((tag, re.compile(pattern)) for tag, pattern in patterns.items())
+
+transcriptSchema = pyarrow.schema([("time", pyarrow.timestamp("ms")), ("content", pyarrow.string()),
+	("agent", pyarrow.string()), ("target", pyarrow.string()), ("word", pyarrow.string())])
+playerSchema = pyarrow.schema([("agentNumber", pyarrow.string()), ("status", pyarrow.string()), ("points", pyarrow.int64()),
+	("contacts", pyarrow.int64()), ("enemyReports", pyarrow.int64()), ("intercepted", pyarrow.int64()),
+	("spurious", pyarrow.int64()), ("words", pyarrow.list_(pyarrow.string()))])
+
+def transcriptRow(entry):
+	match = patterns.get(entry["tag"]) and patterns[entry["tag"]].match(entry["content"])
+	fields = match.groupdict() if match else {}
+	return [entry["time"], entry["content"], fields.get("agent"), fields.get("target"), fields.get("word")]
+
+def playerRow(player):
+	return [player["agentNumber"], player.get("status"), player.get("points", 0), player.get("contacts", 0),
+		player.get("enemyReports", 0), player.get("intercepted", 0), player.get("spurious", 0), player.get("words", [])]
+
+def toTable(rows, schema):
+	columns = zip(*rows)
+	return pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+# Writes rows to Parquet a row group at a time, so the whole game never has to be in memory
+class BatchedWriter(object):
+	def __init__(self, path, schema, batch):
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		self.writer = pyarrow.parquet.ParquetWriter(path, schema)
+		self.schema = schema
+		self.batch = batch
+		self.rows = []
+		self.written = 0
+
+	def append(self, row):
+		self.rows.append(row)
+		if len(self.rows) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		if self.rows:
+			self.writer.write_table(toTable(self.rows, self.schema))
+			self.written += len(self.rows)
+			self.rows = []
+
+	def close(self):
+		self.flush()
+		self.writer.close()
+
+def export(source, window, path, schema, toRow, batch, partitionBy=None):
+	writers = {}
+	for document in source.find(window).sort("_id", ASCENDING).batch_size(batch):
+		partition = document[partitionBy] if partitionBy else None
+		if partition not in writers:
+			filename = os.path.join(path, partitionBy+"="+partition, "part-0.parquet") if partitionBy else path
+			writers[partition] = BatchedWriter(filename, schema, batch)
+		writers[partition].append(toRow(document))
+	for writer in writers.values():
+		writer.close()
+	return dict((partition, writer.written) for partition, writer in writers.items())
+
+mongoclientURL = os.environ['MONGOHQ_URL']
+database = MongoClient(mongoclientURL)[mongoclientURL.split("/")[-1]]
+games = database[collectionnames.games]
+
+if args.game:
+	game = games.find_one({"_id": ObjectId(args.game)})
+else:
+	game = games.find_one(sort=[("_id", -1)])
+if not game:
+	raise SystemExit("No such game.")
+# ObjectIds start with their creation time, so the window is a range of _ids (which are indexed)
+window = {"_id": {"$gte": ObjectId.from_datetime(game["_id"].generation_time)}}
+nextGame = games.find_one({"_id": {"$gt": game["_id"]}}, sort=[("_id", 1)])
+if nextGame:
+	window["_id"]["$lt"] = ObjectId.from_datetime(nextGame["_id"].generation_time)
+
+counts = export(database[collectionnames.transcript], window, os.path.join(args.directory, "transcript"), transcriptSchema, transcriptRow, args.batch, partitionBy="tag")
+for tag, count in sorted(counts.items()):
+	print "%-28s %8d lines" % (tag, count)
+counts = export(database[collectionnames.players], window, os.path.join(args.directory, "players.parquet"), playerSchema, playerRow, args.batch)
+print "%-28s %8d" % ("players", sum(counts.values()))
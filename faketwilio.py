@@ -0,0 +1,34 @@
+# An offline stand-in for twilio.rest.TwilioRestClient.
+# It only implements what makenight uses (client.sms.messages.create), never touches the network,
+# and keeps every message it "sends" so benchmarks can count them afterwards.
+# makenight uses it instead of the real client when the FAKE_TWILIO environment variable is set.
+import random
+import time
+import twilio
+
+
+class FakeMessages(object):
+	def __init__(self, latency, failureRate):
+		self.latency = latency
+		self.failureRate = failureRate
+		self.sent = []
+
+	def create(self, body, to, from_):
+		# time.sleep yields to other greenlets once gevent has monkey-patched it
+		time.sleep(self.latency)
+		if random.random() < self.failureRate:
+			raise twilio.TwilioRestException(500, "/fake/SMS/Messages", "simulated Twilio failure")
+		message = {"body": body, "to": to, "from_": from_, "time": time.time()}
+		self.sent.append(message)
+		return message
+
+
+class FakeSMS(object):
+	def __init__(self, latency, failureRate):
+		self.messages = FakeMessages(latency, failureRate)
+
+
+# latency: seconds each send takes; failureRate: fraction of sends that raise TwilioRestException
+class FakeTwilioClient(object):
+	def __init__(self, latency=0.2, failureRate=0.0):
+		self.sms = FakeSMS(latency, failureRate)
@@ -0,0 +1,69 @@
+# Questions about a game, answered from the files exportgame.py wrote rather than from Mongo.
+#
+#   python gamestats.py archive/    prints a summary
+#
+# or, from Python:
+#
+#   import gamestats
+#   archive = gamestats.load("archive/")
+#   gamestats.throughput(archive)
+#
+# Needs pyarrow, like exportgame.py.
+import sys
+from collections import Counter, defaultdict
+import pyarrow.parquet
+
+# Points each transcript tag gave to its agent and its target (the same rules as reportFriend/reportEnemy)
+pointsByTag = {
+	"successfulcontact": (10, 10),
+	"incorrectcontact": (-2, 0),
+	"interceptedtransmit": (3, -2),
+	"spuriousreport": (-2, 0),
+	}
+
+# The transcript lines as dicts, in time order
+def load(directory):
+	rows = pyarrow.parquet.read_table(directory.rstrip("/")+"/transcript").to_pydict()
+	lines = [dict(zip(rows.keys(), values)) for values in zip(*rows.values())]
+	for line in lines:
+		line["tag"] = str(line["tag"])	# it comes back from the partition name
+	lines.sort(key=lambda line: line["time"])
+	return lines
+
+# Lines per minute for each of tags, as (minute, {tag: count}) in time order
+def throughput(lines, tags=("incoming", "sentmessage", "parsererror")):
+	minutes = defaultdict(Counter)
+	for line in lines:
+		if line["tag"] in tags:
+			minutes[line["time"].replace(second=0, microsecond=0)][line["tag"]] += 1
+	return sorted(minutes.items())
+
+# Each agent's points after every change to them, as {agentNumber: [(time, points), ...]}
+def scoreTimelines(lines):
+	points = Counter()
+	timelines = defaultdict(list)
+	for line in lines:
+		if line["tag"] not in pointsByTag:
+			continue
+		for agentNumber, adjustment in zip([line["agent"], line["target"]], pointsByTag[line["tag"]]):
+			if agentNumber and adjustment:
+				points[agentNumber] += adjustment
+				timelines[agentNumber].append((line["time"], points[agentNumber]))
+	return dict(timelines)
+
+# The n words most often reported as codes when they weren't, as (word, times)
+def topSpuriousWords(lines, n=10):
+	return Counter(line["word"] for line in lines if line["tag"] == "spuriousreport" and line["word"]).most_common(n)
+
+if __name__ == "__main__":
+	lines = load(sys.argv[1])
+	print "Per minute (incoming / sent / parser errors):"
+	for minute, counts in throughput(lines):
+		print "  %s %6d %6d %6d" % (minute.strftime("%H:%M"), counts["incoming"], counts["sentmessage"], counts["parsererror"])
+	print "Final scores:"
+	finals = [(timeline[-1][1], agentNumber) for agentNumber, timeline in scoreTimelines(lines).items()]
+	for points, agentNumber in sorted(finals, reverse=True)[:10]:
+		print "  %-6s %6d" % (agentNumber, points)
+	print "Most spuriously reported words:"
+	for word, times in topSpuriousWords(lines):
+		print "  %-20s %6d" % (word, times)
@@ -1,21 +1,29 @@
 import random
 import re
-import string
+import smsparser
 
 
+# Deal numberOfGroups lists of groupSize words out of inputString. No word is on more than one list
+# (unless it's in inputString more than once). One random sample of the whole pool, cut into groups,
+# so it's linear in the number of words handed out.
 def makeLists(inputString, groupSize, numberOfGroups):
-	inputList = re.split('\W+', inputString)
-	outputList = []
-	for i in range(numberOfGroups):
-		groupList = []
-		for j in range(groupSize):
-			groupList.append(inputList.pop(random.randint(0,len(inputList)-1)))
-		outputList.append(groupList)
-	return outputList
+	inputList = [word for word in re.split('\W+', inputString) if word]
+	words = random.sample(inputList, groupSize * numberOfGroups)
+	return [words[i * groupSize:(i + 1) * groupSize] for i in range(numberOfGroups)]
 
+# A games document ready to be inserted (see newgame.py)
+def makeGame(inputString, groupSize, numberOfGroups):
+	return {
+		"status": "active",
+		"wordlists": makeLists(inputString, groupSize, numberOfGroups),
+		"spuriousReports": [],
+		"assignedAgents": 0
+		}
 
+
+# (the same tokenizer gameLogic uses on incoming texts)
 def cleanAndList(rawcontent):
-	content = re.split('\W+', rawcontent.strip().lower().strip(string.punctuation))
-	return content
+	return smsparser.tokenize(rawcontent)
 
-print cleanAndList("  .heLlo 08")
+if __name__ == "__main__":
+	print cleanAndList("  .heLlo 08")
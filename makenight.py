@@ -6,21 +6,123 @@ from twilio.rest import TwilioRestClient
 import os
 import sys
 from pymongo import *
+from pymongo.errors import BulkWriteError, PyMongoError, OperationFailure, DuplicateKeyError
+from pymongo import monitoring
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import datetime
-import random
 import re
-import string
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 from functools import wraps
+import gevent
+from gevent.queue import JoinableQueue, Queue
+from gevent.pool import Pool
+import time
+import atexit
+import bisect
+import signal
+import uuid
+from collections import OrderedDict
+from faketwilio import FakeTwilioClient
+import smsparser
+import collectionnames
+import zlib
+from bson.binary import Binary
 
 debug = False
+startedAt = time.time()
 app = Flask(__name__)
 
-socketio = SocketIO(app)
+# With several workers, SOCKETIO_QUEUE is the Redis URL they share (see "Workers" below)
+socketioQueue = os.environ.get('SOCKETIO_QUEUE')
+socketio = SocketIO(app, message_queue=socketioQueue)
 
 english = 0
 french = 1
 
+# ----------- Metrics --------------
+# Count, total time and a latency histogram for each instrumented operation, keyed by
+# (operation, label); the label is e.g. the kind of message for gameLogic or the endpoint for requests.
+# Served in Prometheus text format at /leaconsole/metrics.
+histogramBuckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+timings = {}
+
+def recordTiming(operation, seconds, label=""):
+	timing = timings.get((operation, label))
+	if timing is None:
+		timing = timings[(operation, label)] = {"count": 0, "total": 0.0, "buckets": [0] * len(histogramBuckets)}
+	timing["count"] += 1
+	timing["total"] += seconds
+	bucket = bisect.bisect_left(histogramBuckets, seconds)
+	if bucket < len(histogramBuckets):
+		timing["buckets"][bucket] += 1
+
+# Decorator that records how long every call takes, under the function's name
+def timed(f):
+	@wraps(f)
+	def decorated(*args, **kwargs):
+		start = time.time()
+		try:
+			return f(*args, **kwargs)
+		finally:
+			recordTiming(f.__name__, time.time() - start)
+	return decorated
+
+@app.before_request
+def startRequestTimer():
+	g.requestStart = time.time()
+
+@app.teardown_request
+def stopRequestTimer(exception=None):
+	if hasattr(g, "requestStart"):
+		recordTiming("request", time.time() - g.requestStart, request.endpoint or "")
+
+def metricsText():
+	lines = ["# TYPE makenight_operation_seconds histogram"]
+	for (operation, label), timing in sorted(timings.items()):
+		labels = 'operation="%s",label="%s"' % (operation, label)
+		cumulative = 0
+		for bound, count in zip(histogramBuckets, timing["buckets"]):
+			cumulative += count
+			lines.append('makenight_operation_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+		lines.append('makenight_operation_seconds_bucket{%s,le="+Inf"} %d' % (labels, timing["count"]))
+		lines.append('makenight_operation_seconds_sum{%s} %f' % (labels, timing["total"]))
+		lines.append('makenight_operation_seconds_count{%s} %d' % (labels, timing["count"]))
+	for name, stats in [("cache", cacheStats), ("outbox", outboxStats), ("transcript", transcriptStats), ("dedup", dedupStats), ("startup", startupStats), ("socket", emitStats)]:
+		for key, value in sorted(stats.items()):
+			lines.append('makenight_%s_%s %d' % (name, key, value))
+	lines.append('makenight_outbox_depth %d' % outbox.qsize())
+	lines.append('makenight_transcript_depth %d' % transcriptDepth())
+	return "\n".join(lines) + "\n"
+
+# A sampling profiler for the console: while it's running, a SIGPROF every profileInterval seconds of
+# CPU time records the stack that was executing, and profileReport lists the most common stacks.
+profileInterval = 0.005
+profileSamples = {}
+
+def sampleStack(signum, frame):
+	stack = []
+	while frame is not None:
+		stack.append(frame.f_code.co_name + "@" + os.path.basename(frame.f_code.co_filename) + ":" + str(frame.f_code.co_firstlineno))
+		frame = frame.f_back
+	key = ";".join(reversed(stack))
+	profileSamples[key] = profileSamples.get(key, 0) + 1
+
+def startProfiler():
+	profileSamples.clear()
+	signal.signal(signal.SIGPROF, sampleStack)
+	# otherwise a sample landing in blocking I/O makes it fail with EINTR
+	signal.siginterrupt(signal.SIGPROF, False)
+	signal.setitimer(signal.ITIMER_PROF, profileInterval, profileInterval)
+
+def stopProfiler():
+	signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+# The 50 most sampled stacks, root first, in the "collapsed" format flame graph tools read
+def profileReport():
+	samples = sorted(profileSamples.items(), key=lambda item: -item[1])[:50]
+	return "\n".join(stack + " " + str(count) for stack, count in samples) + "\n"
+
 # ----------- Setup --------------
 # Twilio account info, to be gotten from Heroku environment variables
 account_sid = os.environ['ACCOUNT_SID'] 
@@ -32,164 +134,361 @@ twilioNumbers = [os.environ['TWILIO']]
 # (different languages are accessed by the player via different phone numbers; we respond via the same number they used.)
 mynumber = os.environ['ME']
 # Init twilio
-twilioclient = TwilioRestClient(account_sid, auth_token)
+# Setting FAKE_TWILIO swaps in an offline stand-in (its value is the simulated latency of one send, in seconds)
+if os.environ.get('FAKE_TWILIO'):
+	twilioclient = FakeTwilioClient(latency=float(os.environ['FAKE_TWILIO']))
+else:
+	twilioclient = TwilioRestClient(account_sid, auth_token)
+
+# Outbound SMS settings (see "Outbox" below)
+outboxWorkers = int(os.environ.get('OUTBOX_WORKERS', 4))
+outboxSize = int(os.environ.get('OUTBOX_SIZE', 1000))
+# Messages per second per sending number, 0 for no limit. Twilio's API takes messages faster than a
+# number can send them and queues them itself, so by default we don't hold anything back; set this to
+# the account's rate if Twilio starts refusing messages (429s).
+sendsPerSecond = float(os.environ.get('SENDS_PER_SECOND', 0))
+outboxRetries = int(os.environ.get('OUTBOX_RETRIES', 3))
+outboxBackoff = float(os.environ.get('OUTBOX_BACKOFF', 1))
+# Sends in flight at once during a console broadcast (see "Broadcasts" below)
+broadcastConcurrency = int(os.environ.get('BROADCAST_CONCURRENCY', 10))
+
+# Seconds socket messages are held so they can go out together (see "Socket" below); 0 sends each one at once
+emitInterval = float(os.environ.get('EMIT_INTERVAL', 0.25))
+
+# Transcript buffering (see "Transcript" below)
+transcriptBatchSize = int(os.environ.get('TRANSCRIPT_BATCH', 50))
+transcriptFlushInterval = float(os.environ.get('TRANSCRIPT_FLUSH', 1))
+# Most lines kept waiting while Mongo won't take them; past this the oldest are dropped
+transcriptMaxBuffer = int(os.environ.get('TRANSCRIPT_MAX_BUFFER', 10000))
+# Lines per page of /leatranscript
+transcriptPageSize = int(os.environ.get('TRANSCRIPT_PAGE', 200))
+
+# Inbound deduplication (see "Deduplication" below): how many MessageSids to remember in memory,
+# and for how many seconds a MessageSid counts as already handled
+dedupSize = int(os.environ.get('DEDUP_SIZE', 10000))
+dedupTTL = int(os.environ.get('DEDUP_TTL', 3600))
+
+# Snapshots of the active game (see "Snapshots" below): how often to take one (0 turns them off),
+# and where to keep it. Without SNAPSHOT_FILE it's kept in Mongo, since a Heroku dyno loses its files when it restarts.
+snapshotInterval = float(os.environ.get('SNAPSHOT_INTERVAL', 60))
+snapshotFile = os.environ.get('SNAPSHOT_FILE')
 
 # MongoHQ account info, also from Heroku environment variables
 mongoclientURL = os.environ['MONGOHQ_URL']
 databasename = mongoclientURL.split("/")[-1] #gets the last bit of the URL, which is the database name
+# Mongo commands slower than this many milliseconds get logged
+slowQueryMs = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+# Logs every Mongo command that takes longer than slowQueryMs, along with the command itself
+class SlowQueryLogger(monitoring.CommandListener):
+	def __init__(self):
+		self.commands = {}
+
+	def started(self, event):
+		self.commands[event.request_id] = event.command
+
+	def succeeded(self, event):
+		command = self.commands.pop(event.request_id, None)
+		recordTiming("mongo", event.duration_micros / 1000000.0, event.command_name)
+		if event.duration_micros > slowQueryMs * 1000:
+			print "slow query (%dms): %s %s" % (event.duration_micros / 1000, event.command_name, command)
+
+	def failed(self, event):
+		self.commands.pop(event.request_id, None)
+
+# (listeners have to be registered before the client is created)
+monitoring.register(SlowQueryLogger())
 
 # Init Mongo
 mongoclient = MongoClient(mongoclientURL)
 database = mongoclient[databasename]	#loads the assigned database
-players = database["players"]	#loads or makes the collection, whichever should happen
-transcripts = database["transcript"]
-games = database["games"]
+players = database[collectionnames.players]	#loads or makes the collection, whichever should happen
+transcripts = database[collectionnames.transcript]
+games = database[collectionnames.games]
+inbound = database[collectionnames.inbound]	# MessageSids of handled texts, expired by a TTL index
+snapshots = database[collectionnames.snapshots]
+reports = database[collectionnames.reports]	# one document per report an agent made (see recordReport)
+
+# Every hot query filters on one of these. create_index does nothing if the index is already there.
+def ensureIndexes():
+	for collection, field, options in [(players, "agentNumber", {"unique": True}), (players, "phoneNumber", {"unique": True}), (players, "status", {}),
+			(games, "status", {}), (transcripts, "time", {}), (transcripts, "tag", {}), (inbound, "time", {"expireAfterSeconds": dedupTTL}),
+			(reports, [("game", ASCENDING), ("reporter", ASCENDING), ("target", ASCENDING), ("word", ASCENDING), ("kind", ASCENDING)], {"unique": True})]:
+		try:
+			collection.create_index(field, background=True, **options)
+		except OperationFailure as e:
+			# most likely duplicate agent or phone numbers already in the collection; fix those by hand
+			print "couldn't index "+collection.name+"."+str(field)+": "+str(e)
+
+ensureIndexes()
 
 # Init password for console and transcript
 password = os.environ['PW']
 
-# ----------- Helpers --------------
-# Find the first entry in the collection with the "field" field containing fieldvalue. Return the value of the field named in "response."
-def lookup(collection, field, fieldvalue, response):
-	return collection.find({field:fieldvalue}, {response:1, "_id":0})[0][response] 
-	# "find" returns an array of objects; the first one ought to be the one we want
-	# (if more than one thing is possible, look it up manually)
+# ----------- Cache --------------
+# Process-local copies of the active game and of player records, so that the game helpers
+# don't go back to Mongo for every field they need. Players are indexed both by agentNumber
+# and by phoneNumber; both indexes point at the same dict, so a write only has to touch one.
+# Reads come from here; writes go to Mongo first and are then mirrored into the cached record.
+# The active game's wordlists are also indexed when the game is loaded (see indexGame).
+cache = {"game": None, "byAgent": {}, "byPhone": {}, "wordIndex": {}, "teamWords": [], "teamIds": {}, "teams": {}, "ranking": None, "rankedPoints": {}, "scoreVersions": {}, "touched": None}
+cacheStats = {"hits": 0, "misses": 0}
+
+def cachePlayer(player):
+	if player:
+		touchPlayer(player["agentNumber"])
+		# (its team is worked out again from the words it has now)
+		cache["teams"].pop(player["agentNumber"], None)
+		cache["byAgent"][player["agentNumber"]] = player
+		cache["byPhone"][player["phoneNumber"]] = player
+	return player
+
+# Drops agentNumber's cached record, so that it's read from Mongo again when it's next needed
+def uncachePlayer(agentNumber):
+	player = cache["byAgent"].pop(agentNumber, None)
+	if player:
+		cache["byPhone"].pop(player["phoneNumber"], None)
+	cache["teams"].pop(agentNumber, None)
+	touchPlayer(agentNumber)
+
+# Note that agentNumber's cached record changed, for a reconcile that's reading players (see reconcileSnapshot)
+def touchPlayer(agentNumber):
+	if cache["touched"] is not None:
+		cache["touched"].add(agentNumber)
+
+# Returns the active game document, or None if there isn't one.
+def getActiveGame():
+	if cache["game"] is not None:
+		cacheStats["hits"] += 1
+		return cache["game"]
+	cacheStats["misses"] += 1
+	cache["game"] = games.find_one({"status":"active"})
+	indexGame(cache["game"])
+	return cache["game"]
+
+# A team is everyone holding the same wordlist, and is identified by a small integer "team id".
+# wordIndex maps each word of the game to the id of the wordlist it's on, teamWords[id] is that
+# wordlist as a frozenset, and teams maps agentNumber to team id. That turns the report checks into
+# an integer comparison (friends) or a set/dict membership test (enemies, spurious words).
+def indexGame(game):
+	cache["wordIndex"] = {}
+	cache["teamWords"] = []
+	cache["teamIds"] = {}
+	cache["teams"] = {}
+	if game:
+		for wordlist in game["wordlists"]:
+			teamId = teamForWords(wordlist)
+			for word in wordlist:
+				cache["wordIndex"].setdefault(word, teamId)
+
+# Returns the team id for a wordlist, giving it a new id if it isn't one of the game's
+# (which can happen if a player's record was edited by hand)
+def teamForWords(words):
+	key = frozenset(words)
+	if key not in cache["teamIds"]:
+		cache["teamIds"][key] = len(cache["teamWords"])
+		cache["teamWords"].append(key)
+	return cache["teamIds"][key]
+
+def getTeam(player):
+	team = cache["teams"].get(player["agentNumber"])
+	if team is None:
+		team = cache["teams"][player["agentNumber"]] = teamForWords(player["words"])
+	return team
 
-def checkFor(collection, field, fieldvalue):
-	return collection.find({field: fieldvalue}).count() > 0
+# Returns the player record for agentNumber, or None if there's no such agent.
+def getPlayer(agentNumber):
+	player = cache["byAgent"].get(agentNumber)
+	if player is not None:
+		cacheStats["hits"] += 1
+		return player
+	cacheStats["misses"] += 1
+	return cachePlayer(players.find_one({"agentNumber":agentNumber}))
 
-def isAgentNumber(word):
-	return re.match("\d{2,3}", word)
+# Returns the player record for phoneNumber, or None if it's an unknown phone.
+def getPlayerByPhone(phoneNumber):
+	player = cache["byPhone"].get(phoneNumber)
+	if player is not None:
+		cacheStats["hits"] += 1
+		return player
+	cacheStats["misses"] += 1
+	return cachePlayer(players.find_one({"phoneNumber":phoneNumber}))
+
+# Drop everything; the next read of each record goes back to Mongo.
+# Needed whenever the database is edited by hand (new game, new wordlists, fixed player records).
+def invalidateCache():
+	cache["game"] = None
+	cache["byAgent"].clear()
+	cache["byPhone"].clear()
+	cache["ranking"] = None
+	cache["rankedPoints"] = {}
+	cache["scoreVersions"] = {}
+	indexGame(None)
+
+# ----------- Deduplication --------------
+# Twilio retries a webhook that times out, with the same MessageSid. A retry must not be played
+# through gameLogic again, or the agent gets a second round of replies (and "already reported" texts).
+# Recently seen MessageSids are kept in an in-memory LRU for the fast path; the inbound collection
+# (with a unique _id and a TTL index) catches retries that land on another worker or after a restart.
+recentMessages = OrderedDict()	# MessageSid -> time first seen, oldest first
+dedupStats = {"duplicates": 0}
+
+# Returns True the first time a MessageSid is seen, and False for any retry of it
+def firstDelivery(messageSid):
+	now = time.time()
+	seen = recentMessages.pop(messageSid, None)
+	if seen is not None and now - seen < dedupTTL:
+		recentMessages[messageSid] = seen
+		dedupStats["duplicates"] += 1
+		return False
+	recentMessages[messageSid] = now
+	while len(recentMessages) > dedupSize:
+		recentMessages.popitem(last=False)
+	try:
+		inbound.insert_one({"_id": messageSid, "time": datetime.datetime.utcnow()})
+	except DuplicateKeyError:
+		dedupStats["duplicates"] += 1
+		return False
+	return True
 
 # ----------- Game --------------
-# "leaving" removes the player from active status
+# "leaving" removes the player from active status; anything a retired player sends after that is only transcribed
 # A message containing just a number from a previously unknown phoneNumber should cause the creation of new agent at that phoneNumber with the content as their agentNumber.
 # A message containing just a number from a known phoneNumber should check if the number in the content is the number of an agent friendly to the sender.
 # A message containing a number and a word from a known phoneNumber should check if the number and word in the content correspond to an enemy agent.
 # Anything else should respond with a help message
+# Returns what kind of message it turned out to be ("join", "friend", "enemy", "parseerror", ...), for the metrics.
 
 def gameLogic(phoneNumber, rawcontent, language = 0):
-	if not checkFor(games, "status", "active"):
+	if not getActiveGame():
 		transcript(content="No active game; received \'"+rawcontent+"\' from phone number: "+phoneNumber, tag="parsererror")
-		return
+		return "nogame"
 	agentNumber = getAgentNumber(phoneNumber)
 	# unrecognized number should create a new agent, getting agentName from content
 	if not agentNumber:
 		newAgent(phoneNumber, rawcontent, language)
-		return
+		return "join"
 	# recognized number goes on to be treated as a game action
 	else:
 		transcript(content="Agent "+agentNumber+" sent: "+rawcontent, tag="incoming")
+		# retired agents are out of the game: their texts are kept in the transcript but not acted on
+		if getPlayer(agentNumber)["status"] == "retired":
+			return "retired"
+		command = smsparser.parse(rawcontent)
 		# "leaving" removes the player from active status
-		if re.match("leaving", rawcontent.lower()):
+		if isinstance(command, smsparser.Leave):
 			retireAgent(agentNumber, language)
+			return "leave"
+		# a lone agent number is a potential report of friendly contact
+		elif isinstance(command, smsparser.Friend):
+			reportFriend(agentNumber, command.agentNumber, language)
+			return "friend"
+		# an agent number and one suspicious word is a potential enemy intelligence report
+		elif isinstance(command, smsparser.Enemy):
+			reportEnemy(agentNumber, command.agentNumber, command.word, language)
+			return "enemy"
+		elif command.reason == "toomanywords":
+			sendMessage(agentNumber, ["Please only report one suspicious word at a time, agent.", "Merci de ne rapporter qu'un seul mot suspect a la fois, Agent."], language)
+			return "toomanywords"
 		else:
-			# chop rawcontent into a list of lowercase words, separating on whitespace and punctuation
-			content = re.split('\W+', rawcontent.strip().lower().strip(string.punctuation))
-			# if there's only one word, treat it as a potential report of friendly contact
-			if len(content) == 1:
-				if isAgentNumber(content[0]):
-					reportFriend(agentNumber, content[0], language)
-				else:
-					parserError(agentNumber, rawcontent, language)
-			# otherwise, treat it as a potential enemy intelligence report (one agent name, one suspicious word)
-			else:
-				accusee = None
-				for i in range(len(content)):
-					# if any of the words is an agent number, pull it out and store it as the accusee
-					if isAgentNumber(content[i]):
-						accusee = content.pop(i)
-						break
-				if accusee:
-					if len(content) == 1:
-						reportEnemy(agentNumber, accusee, content[0], language)
-					else:
-						sendMessage(agentNumber, ["Please only report one suspicious word at a time, agent.", "Merci de ne rapporter qu'un seul mot suspect a la fois, Agent."], language)
-				else:
-					parserError(agentNumber, rawcontent, language)
+			parserError(agentNumber, rawcontent, language)
+			return "parseerror"
 
 def getAgentNumber(phoneNumber):
 	# first check if it's a known phoneNumber
-	if checkFor(players, "phoneNumber", phoneNumber):
-		agentNumber = lookup(collection=players, field="phoneNumber", fieldvalue=phoneNumber, response="agentNumber")
-		return agentNumber
-	else:
-		return False
-
-def getPhoneNumber(agentNumber):
-	if checkFor(players, "agentNumber", agentNumber):
-		phoneNumber = lookup(collection=players, field="agentNumber", fieldvalue=agentNumber, response="phoneNumber")
-		return phoneNumber
+	player = getPlayerByPhone(phoneNumber)
+	if player:
+		return player["agentNumber"]
 	else:
 		return False
 
 # At any given time, there is one "active" game in the games collection. "wordlists" contains a list of wordlists.
+# New agents are dealt onto the wordlists in turn, so team sizes never differ by more than one. The turn
+# comes from the game's "assignedAgents" counter, which is shared by every worker and survives restarts.
 def assignWords():
-	wordlists = lookup(collection=games, field="status", fieldvalue="active", response="wordlists")
-	wordlist = random.choice(wordlists)
+	wordlists = getActiveGame()["wordlists"]
+	game = games.find_one_and_update({"status":"active"}, {"$inc":{"assignedAgents":1}}, projection={"assignedAgents":1, "_id":0}, return_document=ReturnDocument.AFTER)
+	wordlist = wordlists[(game["assignedAgents"] - 1) % len(wordlists)]
 	return wordlist
 
 # Assign the new agent their wordlist, enter them into the database, and message them their list.
 # (Don't try to use sendMessage with an agentNumber before they're in the DB!)
 def newAgent(phoneNumber, rawcontent, language):
-	content = re.split('\W+', rawcontent.lower())
-	agentNumber = content[0]
-	if checkFor(players, "agentNumber", agentNumber):
-		sendMessage(agentNumber=None, content=["That number seems to be taken. Please see Q to sort things out.", "Ce numéro semble être pris. Voyez avec Q pour regler le problème."], language = language, phoneNumber=phoneNumber)
+	command = smsparser.parseJoin(rawcontent)
+	if isinstance(command, smsparser.Invalid):
+		sendMessage(agentNumber=None, contentList=["I didn't understand that as an agent number. Please see Q to sort things out.", "Ceci ne ressemblait pas a un numero d'agent. Voyez avec Q pour régler le probleme."], language = language, phoneNumber=phoneNumber)
 		return
-	elif not isAgentNumber(agentNumber):
-		sendMessage(agentNumber=None, content=["I didn't understand that as an agent number. Please see Q to sort things out.", "Ceci ne ressemblait pas a un numero d'agent. Voyez avec Q pour régler le probleme."], language = language, phoneNumber=phoneNumber)
+	agentNumber = command.agentNumber
+	taken = ["That number seems to be taken. Please see Q to sort things out.", "Ce numéro semble être pris. Voyez avec Q pour regler le problème."]
+	if getPlayer(agentNumber):
+		sendMessage(agentNumber=None, contentList=taken, language = language, phoneNumber=phoneNumber)
 		return
 	else:
+		# the record goes in complete, so nothing can read the agent without their wordlist. Losing a race
+		# with another join (the unique indexes catch it) does use up a team's turn, but that's rare.
 		wordlist = assignWords()
-		players.insert({
-			"agentNumber": agentNumber,
-			"phoneNumber": phoneNumber,
-			"status": "active",
-			"words": wordlist,
-			"successfulContacts":[],
-			"interceptedTransmits":[],
-			"reportedEnemyCodes":[],
-			"spuriousReports":[],
-			"points": 0
-			})
+		player = newPlayerRecord(agentNumber, phoneNumber, wordlist)
+		try:
+			players.insert(player)
+		except DuplicateKeyError:
+			sendMessage(agentNumber=None, contentList=taken, language = language, phoneNumber=phoneNumber)
+			return
+		cachePlayer(player)
 		success = sendMessage(agentNumber, ["Greetings, Agent "+agentNumber+"! Your code words are as follows: "+", ".join(wordlist), "Bienvenue, Agent "+agentNumber+"! Voici vos mots-code: "+", ".join(wordlist)], language = language)
 		transcript(content="New agent: "+agentNumber, tag="newagent")
-		socketio.emit("message", {"type": "scorechange", "agentNumber": agentNumber, "points": 0})
+		scoreChanged(agentNumber, 0, 0)
 		return
 
+# What goes in the players collection for a new agent. What they've reported is kept in the reports
+# collection; the player only keeps count of it.
+def newPlayerRecord(agentNumber, phoneNumber, words):
+	return {
+		"agentNumber": agentNumber,
+		"phoneNumber": phoneNumber,
+		"status": "active",
+		"words": words,
+		"contacts": 0,	# friendly contacts made
+		"enemyReports": 0,	# enemy codes correctly reported
+		"intercepted": 0,	# times an enemy caught them using a code
+		"spurious": 0,	# wrong enemy reports
+		"points": 0,
+		"scoreVersion": 0	# how many times points has changed (see setScore)
+		}
+
+# (the goodbye is sent first, since sendMessage doesn't message retired agents)
 def retireAgent(agentNumber, language=english):
+	sendMessage(agentNumber, ["Good work and goodnight, Agent "+agentNumber+".", "Beau travail, et bonne nuit, Agent "+agentNumber+"."], language = language)
 	players.update({"agentNumber":agentNumber}, {"$set":{"status":"retired"}})
+	player = cache["byAgent"].get(agentNumber)
+	if player:
+		player["status"] = "retired"
+	touchPlayer(agentNumber)
+	publishChange({"type": "player", "agentNumber": agentNumber})
 	transcript(content="Agent retired: "+agentNumber, tag="agentretired")
-	sendMessage(agentNumber, ["Good work and goodnight, Agent "+agentNumber+".", "Beau travail, et bonne nuit, Agent "+agentNumber+"."], language = language)
 	return
 
 def parserError(agentNumber, rawcontent, language=english):
 	transcript(content="Agent "+agentNumber+"\'s message is unparseable: "+rawcontent, tag="parsererror")
 	sendMessage(agentNumber, ["Pardon? Visit Q if you are having trouble forming reports.", "Pardon? Allez voir Q si vous avez du mal a ecrire des rapports."], language = language)
 
-# Check if the potentialFriend is on the same team as the reportingAgent.  If so, congratulate both, assign points, and list them on each other's successfulContacts.  If not, warn the reportingAgent and demerit them.
+# Check if the potentialFriend is on the same team as the reportingAgent.  If so, congratulate both, assign points, and record their contact.  If not, warn the reportingAgent and demerit them.
 def reportFriend(reportingAgent, potentialFriend, language=english):
 	if reportingAgent == potentialFriend:
 		sendMessage(reportingAgent, ["Please don't waste HQ's time by reporting yourself.", "Merci de ne pas nous faire perdre notre temps en vous identifiant vous-meme."], language = language)
 		return False
-	if not checkFor(players, "agentNumber", potentialFriend):
+	friend = getPlayer(potentialFriend)
+	if not friend:
 		sendMessage(reportingAgent, ["We don't have records of an agent by that number.", "Nous n'avons pas ce numero d'agent dans nos dossiers."], language = language)
 	else:
-		reportingAgentList = lookup(collection=players, field="agentNumber", fieldvalue=reportingAgent, response="words")
-		potentialFriendList = lookup(collection=players, field="agentNumber", fieldvalue=potentialFriend, response="words")
+		reporter = getPlayer(reportingAgent)
 		# check to see if their wordlists are the same
-		if set(reportingAgentList) == set(potentialFriendList):
-			# but don't let them report the same friend more than once
-			existingcontacts = lookup(collection=players, field="agentNumber", fieldvalue=reportingAgent, response="successfulContacts")
-			if not potentialFriend in existingcontacts:
+		if getTeam(reporter) == getTeam(friend):
+			# but don't let them report the same friend more than once (whichever of the two reports it)
+			if recordReport("contact", min(reportingAgent, potentialFriend), max(reportingAgent, potentialFriend)):
+				adjustPlayers([(reportingAgent, "contacts", 10), (potentialFriend, "contacts", 10)])
 				transcript(content="Agents "+reportingAgent+" and "+potentialFriend+" successfully made contact.", tag="successfulcontact")
 				sendMessage(reportingAgent, ["Your report of friendly contact with "+potentialFriend+" checks out.  A major commendation to you both.", "Votre rapport de contact avec l'agent ami "+potentialFriend+" semble correct. Une citation majeure a vous deux."], language = language)
-				addToRecord(reportingAgent, "successfulContacts", potentialFriend)
-				awardPoints(reportingAgent, 10)
 				sendMessage(potentialFriend, ["Congratulations on establishing contact with Agent "+reportingAgent+".", "Felicitations pour avoir etabli le contact avec l'Agent "+reportingAgent+"."], language = language)
-				addToRecord(potentialFriend, "successfulContacts", reportingAgent)
-				awardPoints(potentialFriend, 10)
 				return True
 			else:
 				sendMessage(reportingAgent, ["Contact between yourself and Agent "+potentialFriend+" has already been established.", "Le contact entre vous et l'Agent "+potentialFriend+" a deja ete etabli."], language = language)
@@ -205,22 +504,22 @@ def reportEnemy(reportingAgent, potentialEnemy, suspiciousWord, language=english
 	if reportingAgent == potentialEnemy:
 		sendMessage(reportingAgent, ["Please don't waste HQ's time by reporting yourself.", "Merci de ne pas nous faire perdre notre temps en vous identifiant vous-meme."], language = language)
 		return False
-	if not checkFor(players, "agentNumber", potentialEnemy):
+	enemy = getPlayer(potentialEnemy)
+	if not enemy:
 		sendMessage(reportingAgent, ["We don't have records of an agent by that number.", "Nous n'avons pas ce numero d'agent dans nos dossiers."], language = language)
 		return False
 	else:
-		reportingAgentList = lookup(collection=players, field="agentNumber", fieldvalue=reportingAgent, response="words")
-		potentialEnemyList = lookup(collection=players, field="agentNumber", fieldvalue=potentialEnemy, response="words")
-		previouslyReportedList = lookup(collection=players, field="agentNumber", fieldvalue=reportingAgent, response="reportedEnemyCodes")
-		if potentialEnemy+" "+suspiciousWord in previouslyReportedList:
+		reporter = getPlayer(reportingAgent)
+		reportingAgentList = cache["teamWords"][getTeam(reporter)]
+		potentialEnemyList = cache["teamWords"][getTeam(enemy)]
+		goodReport = suspiciousWord in potentialEnemyList and not suspiciousWord in reportingAgentList
+		# recording a good report fails if it was already made
+		if goodReport and not recordReport("enemy", reportingAgent, potentialEnemy, suspiciousWord):
 			sendMessage(reportingAgent, ["Your report of Agent "+potentialEnemy+"\'s use of code \""+suspiciousWord+"\" was already received.  Do not waste HQ's time with duplicate reports.", "Votre rapport sur l'Agent "+potentialEnemy+" et le code \""+suspiciousWord+"\" a deja ete recu. Ne nous faites pas perdre du temps avec des rapports en double."], language = language)
 		elif suspiciousWord in potentialEnemyList:
 			if not suspiciousWord in reportingAgentList:
 				sendMessage(reportingAgent, ["Good work! Your report of Agent "+potentialEnemy+"\'s use of code \""+suspiciousWord+"\" is valuable intel.", "Beau travail! Votre rapport sur l'Agent "+potentialEnemy+" utilisant le code  \""+suspiciousWord+"\" est un renseignement precieux."], language = language)
-				addToRecord(reportingAgent, "reportedEnemyCodes", potentialEnemy+" "+suspiciousWord)
-				awardPoints(reportingAgent, 3)
-				addToRecord(potentialEnemy, "interceptedTransmits", reportingAgent+" "+suspiciousWord)
-				awardPoints(potentialEnemy, -2)
+				adjustPlayers([(reportingAgent, "enemyReports", 3), (potentialEnemy, "intercepted", -2)])
 				transcript(content="Agent "+reportingAgent+" caught Agent "+potentialEnemy+" transmitting code \""+suspiciousWord+"\"", tag="interceptedtransmit")
 				return True
 			else:
@@ -229,74 +528,567 @@ def reportEnemy(reportingAgent, potentialEnemy, suspiciousWord, language=english
 				return False
 		else:
 			spuriousReport(suspiciousWord)
-			addToRecord(reportingAgent, "spuriousReports", potentialEnemy+" "+suspiciousWord)
+			countReport("spurious", reportingAgent, potentialEnemy, suspiciousWord)
+			adjustPlayers([(reportingAgent, "spurious", -2)])
 			sendMessage(reportingAgent, ["\""+suspiciousWord+"\" does not seem to be that enemy's code. Be more careful.","\""+suspiciousWord+"\" ne semble pas etre un code de cet ennemi. Soyez plus prudent."], language = language)
-			awardPoints(reportingAgent, -2)
 			transcript(content="Agent "+reportingAgent+" spuriously reported Agent "+potentialEnemy+" for the code \""+suspiciousWord+"\"", tag="spuriousreport")
 			return False
 
 
 # Send a message to an agent based on their agentNumber
+@timed
 def sendMessage(agentNumber, contentList, phoneNumber=None, language=english):
 	content = contentList[language]
 	# print content;
 	fromNumber = twilioNumbers[language]
 	if agentNumber and not phoneNumber:
-		phoneNumber = getPhoneNumber(agentNumber)
-		if lookup(collection=players, field="agentNumber", fieldvalue=agentNumber, response="status") is "retired":
+		player = getPlayer(agentNumber)
+		if not player:
+			return False
+		phoneNumber = player["phoneNumber"]
+		if player["status"] == "retired":
 			transcript(content="Didn't send message to retired "+agentNumber+": "+content, tag="sentmessage")
 			return
 	if phoneNumber:
-		if not debug:
-			try:
-				message = twilioclient.sms.messages.create(body=content, to=phoneNumber, from_=fromNumber)
-		 	except twilio.TwilioRestException as e:
-				content = content + " WITH TWILIO ERROR: " + str(e)
-		 	except:
-		 		print "some sort of twilio error"
-	 	if agentNumber:
-			transcript(content="Sent message to "+agentNumber+": "+content, tag="sentmessage")
-		else: 
-			transcript(content="Sent message to unidentified agent: "+content, tag="sentmessage")
+		# the transcript entry is written by the outbox once Twilio has actually taken the message
+		queueMessage(phoneNumber, content, fromNumber, agentNumber)
 		return True
 	else:
 		return False
 
+# ----------- Outbox --------------
+# Outgoing texts are put on a bounded queue and sent by a pool of greenlets, so that neither the
+# Twilio webhook nor a console broadcast has to wait on Twilio's API. Each sending number can be
+# throttled to sendsPerSecond, and sends that Twilio refused for reasons that may go away (a 5xx or
+# a 429) are retried with exponential backoff; other errors, like an invalid number, are given up on
+# straight away. If the queue is full, queueMessage blocks until a worker frees up a slot.
+outbox = JoinableQueue(maxsize=outboxSize)
+outboxStats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0}
+nextSendTime = {}	# sending number -> earliest time its next message may go out
+
+def queueMessage(phoneNumber, content, fromNumber, agentNumber=None):
+	outbox.put({"to": phoneNumber, "from": fromNumber, "body": content, "agentNumber": agentNumber})
+	outboxStats["queued"] += 1
+
+# Reserve the next send slot for fromNumber and sleep until it comes around.
+def throttle(fromNumber):
+	if not sendsPerSecond:
+		return
+	now = time.time()
+	slot = max(now, nextSendTime.get(fromNumber, now))
+	nextSendTime[fromNumber] = slot + 1.0/sendsPerSecond
+	gevent.sleep(slot - now)
+
+# Returns None on success, or the error that made us give up.
+def deliver(message):
+	if debug:
+		return None
+	for attempt in range(outboxRetries + 1):
+		throttle(message["from"])
+		start = time.time()
+		try:
+			twilioclient.sms.messages.create(body=message["body"], to=message["to"], from_=message["from"])
+			recordTiming("twilio", time.time() - start, "sent")
+			return None
+		except twilio.TwilioRestException as e:
+			recordTiming("twilio", time.time() - start, "error")
+			error = e
+			if e.status < 500 and e.status != 429:
+				return e
+			if attempt < outboxRetries:
+				outboxStats["retried"] += 1
+				gevent.sleep(outboxBackoff * 2**attempt)
+		except Exception as e:
+			# not something a retry is going to fix
+			return e
+	return error
+
+def outboxWorker():
+	while True:
+		message = outbox.get()
+		try:
+			error = deliver(message)
+			content = message["body"]
+			if error:
+				outboxStats["failed"] += 1
+				content = content + " WITH TWILIO ERROR: " + str(error)
+			else:
+				outboxStats["sent"] += 1
+			if message["agentNumber"]:
+				transcript(content="Sent message to "+message["agentNumber"]+": "+content, tag="sentmessage")
+			else:
+				transcript(content="Sent message to unidentified agent: "+content, tag="sentmessage")
+		except Exception as e:
+			print "outbox worker error: " + str(e)
+		finally:
+			outbox.task_done()
+
+for i in range(outboxWorkers):
+	gevent.spawn(outboxWorker)
+
+# ----------- Broadcasts --------------
+# A console broadcast is queued and sent in the background, one broadcast at a time. Active agents'
+# phone numbers are streamed from a projected cursor into a pool of broadcastConcurrency sends (the
+# cursor waits whenever the pool is full), and the console gets progress and every failed recipient
+# over the socket. Broadcasts skip the outbox queue, so a long broadcast doesn't push game replies to
+# the back of it, but they share its retries and its per-number rate limit: with SENDS_PER_SECOND set,
+# broadcast sends and game replies take turns at the same send slots, so replies go out more slowly
+# while a broadcast is running. "One at a time" is per worker; with several workers, broadcasts
+# submitted to different workers can run at the same time.
+broadcasts = Queue()
+
+def sendBroadcast(content, fromNumber):
+	progress = {"type": "broadcastprogress", "content": content, "sent": 0, "failed": 0}
+	def send(agent):
+		error = deliver({"to": agent["phoneNumber"], "from": fromNumber, "body": content})
+		if error:
+			progress["failed"] += 1
+			transcript(content="Broadcast to "+agent["agentNumber"]+" failed WITH TWILIO ERROR: "+str(error), tag="broadcast")
+			emitMessage({"type": "broadcastfailure", "agentNumber": agent["agentNumber"], "error": str(error)})
+		else:
+			progress["sent"] += 1
+		if (progress["sent"] + progress["failed"]) % 10 == 0:
+			emitMessage(progress)
+	pool = Pool(broadcastConcurrency)
+	for agent in players.find({"status" : "active"}, {"agentNumber":1, "phoneNumber":1, "_id":0}).batch_size(100):
+		pool.spawn(send, agent)
+	pool.join()
+	progress["done"] = True
+	emitMessage(progress)
+	transcript(content="Broadcast message to "+str(progress["sent"])+" active agents ("+str(progress["failed"])+" failed): "+content, tag="broadcast")
+
+def broadcaster():
+	while True:
+		content, fromNumber = broadcasts.get()
+		try:
+			sendBroadcast(content, fromNumber)
+		except Exception as e:
+			print "broadcast error: " + str(e)
+
+gevent.spawn(broadcaster)
+
+# ----------- Socket --------------
+# Every message to leaderboard, transcript and console clients goes through emitMessage, which holds
+# it for up to emitInterval seconds; then each room gets everything it's owed as one "batch" frame.
+# Each page joins only the room it shows (see joinRoom), so leaderboard clients never get transcript
+# lines. Within a tick, broadcast progress and refreshes keep only the latest, and transcript batches
+# are joined into one. A rankchange only says whose points changed: the frame carries a single
+# "rankchanges" message with each of those agents' points and rank as they are when it's sent, in
+# rank order, so that the board the client ends up with is the one we have (ranks taken at different
+# moments don't add up to one board). emitStats counts frames and their bytes (each client in the
+# room gets a copy).
+roomFor = {"rankchange": "leaderboard", "spurious": "leaderboard", "refresh": "leaderboard",
+	"transcriptbatch": "transcript", "broadcastprogress": "console", "broadcastfailure": "console"}
+pendingEmits = dict((room, OrderedDict()) for room in set(roomFor.values()))
+emitStats = {"events": 0, "coalesced": 0, "frames": 0, "bytes": 0, "framesPerSecond": 0, "bytesPerSecond": 0}
+
+def emitMessage(data):
+	emitStats["events"] += 1
+	pending = pendingEmits[roomFor[data["type"]]]
+	if data["type"] == "rankchange":
+		key = (data["type"], data["agentNumber"])
+	elif data["type"] in ("broadcastprogress", "refresh", "transcriptbatch"):
+		key = (data["type"],)
+	else:
+		key = (data["type"], emitStats["events"])
+	if key in pending:
+		# moved to the end, so the frame keeps the order the latest messages were sent in
+		earlier = pending.pop(key)
+		emitStats["coalesced"] += 1
+		if data["type"] == "transcriptbatch":
+			data = dict(data, entries=earlier["entries"] + data["entries"])
+	pending[key] = data
+	if not emitInterval:
+		flushEmits()
+
+def flushEmits():
+	for room, pending in pendingEmits.items():
+		if not pending:
+			continue
+		events = pending.values()
+		pending.clear()
+		rankChanged = [data["agentNumber"] for data in events if data["type"] == "rankchange"]
+		if rankChanged:
+			events = [rankChanges(rankChanged)] + [data for data in events if data["type"] != "rankchange"]
+		frame = {"type": "batch", "events": events}
+		start = time.time()
+		socketio.emit("message", frame, room=room)
+		recordTiming("socketEmit", time.time() - start, room)
+		emitStats["frames"] += 1
+		emitStats["bytes"] += len(json.dumps(frame))
+
+def rankChanges(agentNumbers):
+	getRanking()
+	changes = [{"agentNumber": agentNumber, "points": cache["rankedPoints"].get(agentNumber), "rank": getRank(agentNumber)} for agentNumber in agentNumbers]
+	return {"type": "rankchanges", "changes": sorted((change for change in changes if change["rank"]), key=lambda change: change["rank"])}
+
+def emitter():
+	lastFrames, lastBytes, lastTime = 0, 0, time.time()
+	while True:
+		gevent.sleep(emitInterval or 1)
+		flushEmits()
+		now = time.time()
+		if now - lastTime >= 1:
+			emitStats["framesPerSecond"] = (emitStats["frames"] - lastFrames) / (now - lastTime)
+			emitStats["bytesPerSecond"] = (emitStats["bytes"] - lastBytes) / (now - lastTime)
+			lastFrames, lastBytes, lastTime = emitStats["frames"], emitStats["bytes"], now
+
+gevent.spawn(emitter)
+
+# ----------- Transcript --------------
+# Transcript lines are buffered in memory and written with a single insert_many once
+# transcriptBatchSize lines are waiting or every transcriptFlushInterval seconds, whichever comes
+# first. The socket gets one "transcriptbatch" frame per flush, of the lines that were written.
+# Lines that couldn't be written are kept for the next flush, but at most transcriptMaxBuffer of them
+# (the oldest go first, and are counted in "dropped"). Buffered lines are flushed again at exit, so a
+# crash (not a normal shutdown) loses what's in the buffer: while Mongo is taking writes, at most
+# transcriptBatchSize lines or transcriptFlushInterval seconds' worth; while it isn't, up to
+# transcriptMaxBuffer lines.
+transcriptBuffer = []
+transcriptStats = {"written": 0, "flushes": 0, "maxDepth": 0, "dropped": 0}
+
+@timed
 def transcript(content, tag):
 	time = datetime.datetime.now()
-	transcripts.insert({"time":time, "tag":tag, "content":content})
-	formattedTime = str(time)[11:16]
-	socketio.emit('message', {"type":"transcript", "time":formattedTime, "tag":tag, "content":content})
+	transcriptBuffer.append({"time":time, "tag":tag, "content":content})
+	transcriptStats["maxDepth"] = max(transcriptStats["maxDepth"], len(transcriptBuffer))
 	print content
+	# (just the once: if lines are piling up because Mongo isn't taking them, the flusher keeps trying)
+	if len(transcriptBuffer) == transcriptBatchSize:
+		flushTranscript()
 	return
 
-# Append to a player's record list (any of "successfulContacts", "interceptedTransmits", "reportedEnemies", or "spuriousReports")
-def addToRecord(agentNumber, field, content):
-	players.update({"agentNumber":agentNumber}, {"$push":{field:content}})
-	return
+# Number of transcript lines waiting to be written
+def transcriptDepth():
+	return len(transcriptBuffer)
 
-# Increments player's points by pointAdjustment
-def awardPoints(agentNumber, pointAdjustment):
-	players.update({"agentNumber":agentNumber}, {"$inc":{"points":pointAdjustment}})
-	socketio.emit("message", {"type": "scorechange", "agentNumber": agentNumber, "points": pointAdjustment})
-	return
+def flushTranscript():
+	global transcriptBuffer
+	if not transcriptBuffer:
+		return
+	entries = transcriptBuffer
+	transcriptBuffer = []
+	written = entries
+	try:
+		transcripts.insert_many(entries, ordered=True)
+		transcriptStats["flushes"] += 1
+	except BulkWriteError as e:
+		# everything before the bad entry made it in, and the bad entry won't do any better next time
+		print "transcript flush failed: " + str(e)
+		written = entries[:e.details["nInserted"]]
+		keepTranscript(entries[e.details["nInserted"]+1:])
+	except PyMongoError as e:
+		print "transcript flush failed: " + str(e)
+		written = []
+		keepTranscript(entries)
+	transcriptStats["written"] += len(written)
+	if written:
+		emitMessage({"type":"transcriptbatch", "entries":[{"time":str(entry["time"])[11:16], "tag":entry["tag"], "content":entry["content"]} for entry in written]})
+
+# Put lines that couldn't be written back for the next flush, ahead of anything logged in the meantime
+def keepTranscript(entries):
+	global transcriptBuffer
+	transcriptBuffer = entries + transcriptBuffer
+	excess = len(transcriptBuffer) - transcriptMaxBuffer
+	if excess > 0:
+		transcriptStats["dropped"] += excess
+		transcriptBuffer = transcriptBuffer[excess:]
+
+# One page of transcript lines matching the tag and agent filters, oldest first.
+# "before" and "after" are _ids of lines already on screen; with neither you get the latest page.
+# (Agent numbers aren't stored separately, so the agent filter matches them as a word in the content.)
+def transcriptPage(tag=None, agent=None, before=None, after=None, limit=transcriptPageSize):
+	query = {}
+	if tag:
+		query["tag"] = tag
+	if agent:
+		query["content"] = {"$regex": "\\b"+re.escape(agent)+"\\b"}
+	if after:
+		query["_id"] = {"$gt": after}
+		return transcripts.find(query).sort("_id", ASCENDING).limit(limit).batch_size(100)
+	if before:
+		query["_id"] = {"$lt": before}
+	return reversed(list(transcripts.find(query).sort("_id", DESCENDING).limit(limit)))
+
+def transcriptFlusher():
+	while True:
+		gevent.sleep(transcriptFlushInterval)
+		flushTranscript()
+
+gevent.spawn(transcriptFlusher)
+atexit.register(flushTranscript)
+
+# Reports are kept in the reports collection, one document per (game, reporter, target, word, kind),
+# where game is the _id of the game it was made in (agent numbers get reused from one game to the
+# next) and kind is "contact" (friendly contact, filed under the lower agent number as reporter so
+# that it doesn't matter which of the two reported it), "enemy" (a correct enemy report) or
+# "spurious" (a wrong one, which can be repeated and is counted). The unique index on those fields
+# makes inserting the report the check for whether it was made before, even when two texts race.
+def reportKey(kind, reporter, target, word):
+	return {"game":getActiveGame()["_id"], "reporter":reporter, "target":target, "word":word, "kind":kind}
+
+# Returns False if the report was already there.
+def recordReport(kind, reporter, target, word=""):
+	try:
+		reports.insert_one(reportKey(kind, reporter, target, word))
+		return True
+	except DuplicateKeyError:
+		return False
+
+def countReport(kind, reporter, target, word=""):
+	key = reportKey(kind, reporter, target, word)
+	try:
+		reports.update_one(key, {"$inc":{"count":1}}, upsert=True)
+	except DuplicateKeyError:
+		# another upsert of the same report inserted it first; now there's one to update
+		reports.update_one(key, {"$inc":{"count":1}})
+
+# Bump a counter and adjust the points of one or more agents.
+# changes is a list of (agentNumber, counter, pointAdjustment).
+def adjustPlayers(changes):
+	for agentNumber, counter, pointAdjustment in changes:
+		awardPoints(agentNumber, pointAdjustment, counter)
+
+# Increments player's points by pointAdjustment (and counter by one, if given). The update hands back
+# the points it left, which is what the cache, the leaderboard and the other workers are told.
+def awardPoints(agentNumber, pointAdjustment, counter=None):
+	increments = {"points":pointAdjustment, "scoreVersion":1}
+	if counter:
+		increments[counter] = 1
+	updated = players.find_one_and_update({"agentNumber":agentNumber}, {"$inc":increments}, projection=dict((field, 1) for field in increments), return_document=ReturnDocument.AFTER)
+	if not updated:
+		return
+	player = cache["byAgent"].get(agentNumber)
+	if player and player.get("scoreVersion", 0) < updated["scoreVersion"]:
+		player.update((field, updated[field]) for field in increments)
+	touchPlayer(agentNumber)
+	scoreChanged(agentNumber, updated["points"], updated["scoreVersion"])
+
+# ----------- Leaderboard --------------
+# Every agent as a (-points, agentNumber) pair, kept sorted with bisect so that the leaderboard never
+# has to scan or sort the players collection. It's loaded from Mongo on first use (and again after
+# invalidateCache) and kept up to date by setScore; rankedPoints holds each agent's current points.
+# Points only ever travel as absolute values, tagged with the player's scoreVersion (which every
+# points change increments), and setScore ignores anything older than what it already has. That way
+# it doesn't matter in which order updates from this worker, other workers and reads of the players
+# collection arrive, or whether a read already included an update: everyone ends up with the latest.
+def getRanking():
+	if cache["ranking"] is None:
+		loaded = list(players.find({}, {"agentNumber":1, "points":1, "scoreVersion":1, "_id":0}))
+		# updates that came in while the read was going are already in rankedPoints, and win if they're newer
+		for player in loaded:
+			setScore(player["agentNumber"], player["points"], player.get("scoreVersion", 0))
+		if cache["ranking"] is None:
+			cache["ranking"] = sorted((-points, agentNumber) for agentNumber, points in cache["rankedPoints"].items())
+	return cache["ranking"]
+
+# Record that agentNumber has points as of its version'th points change, unless a later version is
+# already known, and move it to its place in the ranking (if that's loaded). Returns whether anything changed.
+def setScore(agentNumber, points, version):
+	if version <= cache["scoreVersions"].get(agentNumber, -1):
+		return False
+	oldPoints = cache["rankedPoints"].get(agentNumber)
+	cache["rankedPoints"][agentNumber] = points
+	cache["scoreVersions"][agentNumber] = version
+	ranking = cache["ranking"]
+	if ranking is not None:
+		if oldPoints is not None:
+			del ranking[bisect.bisect_left(ranking, (-oldPoints, agentNumber))]
+		bisect.insort(ranking, (-points, agentNumber))
+	return True
+
+# Takes agentNumber off the leaderboard altogether
+def dropScore(agentNumber):
+	points = cache["rankedPoints"].pop(agentNumber, None)
+	cache["scoreVersions"].pop(agentNumber, None)
+	if points is not None and cache["ranking"] is not None:
+		del cache["ranking"][bisect.bisect_left(cache["ranking"], (-points, agentNumber))]
+
+# 1-based position of agentNumber on the leaderboard, or None for an unknown agent
+def getRank(agentNumber):
+	ranking = getRanking()
+	points = cache["rankedPoints"].get(agentNumber)
+	if points is None:
+		return None
+	return bisect.bisect_left(ranking, (-points, agentNumber)) + 1
+
+# The n highest-scoring agents (all of them if n is None) as (agentNumber, points) pairs
+def topAgents(n=None):
+	return [(agentNumber, -negativePoints) for negativePoints, agentNumber in getRanking()[:n]]
+
+# agentNumber now has points, as of its version'th points change (a new agent comes in with 0 and 0):
+# move it on the leaderboard, tell the other workers, and have leaderboard clients told its points and rank.
+def scoreChanged(agentNumber, points, version):
+	getRanking()
+	setScore(agentNumber, points, version)
+	publishChange({"type": "player", "agentNumber": agentNumber, "points": points, "version": version})
+	emitMessage({"type": "rankchange", "agentNumber": agentNumber})
 
 # Append a spurious word onto the game's record of spurious reports.
 def spuriousReport(suspiciousWord):
-	gameWordList = lookup(collection=games, field="status", fieldvalue="active", response="wordlists")
-	addWord = True
-	for list in gameWordList:
-		for word in list:
-			if word == suspiciousWord:
-				addWord = False
-	if (addWord):
+	game = getActiveGame()
+	# words that are on some wordlist aren't spurious, they just weren't that enemy's
+	if not suspiciousWord in cache["wordIndex"]:
 		games.update({"status":"active"}, {"$push":{"spuriousReports":suspiciousWord}})
-		socketio.emit("message", {"type": "spurious", "word": suspiciousWord})
+		game.setdefault("spuriousReports", []).append(suspiciousWord)
+		publishChange({"type": "spurious", "word": suspiciousWord})
+		emitMessage({"type": "spurious", "word": suspiciousWord})
 	return
 
 	# def lookup(collection, field, fieldvalue, response):
 	# return games.find({"status":"active"}, {"wordlists":1, "_id":0})[0]["wordlists"] 
 
+# ----------- Workers --------------
+# To run more than one worker (WEB_WORKERS in the Procfile, or several dynos), point SOCKETIO_QUEUE
+# at a Redis they can all reach, e.g. redis://localhost:6379/0. Flask-SocketIO then relays every emit
+# through Redis so it reaches the clients of every worker, and each worker tells the others about its
+# writes on workerChannel so that their caches stay coherent: a changed player is dropped from their
+# cache (and re-read from Mongo when next needed) and its new points are set in their ranking.
+# Without SOCKETIO_QUEUE there is only this process, and publishChange does nothing.
+# (The outbox rate limit, if set, is per worker; divide SENDS_PER_SECOND by the number of workers.)
+workerChannel = "makenight-workers"
+workerId = uuid.uuid4().hex
+
+def publishChange(change):
+	if workerBus:
+		change["worker"] = workerId
+		workerBus.publish(workerChannel, json.dumps(change))
+
+# Apply a change published by another worker to this worker's cache
+def applyChange(change):
+	if change["type"] == "player":
+		uncachePlayer(change["agentNumber"])
+		if "points" in change:
+			setScore(change["agentNumber"], change["points"], change["version"])
+	elif change["type"] == "spurious":
+		if cache["game"] is not None:
+			cache["game"].setdefault("spuriousReports", []).append(change["word"])
+	elif change["type"] == "invalidate":
+		invalidateCache()
+
+def listenForChanges():
+	pubsub = workerBus.pubsub()
+	pubsub.subscribe(workerChannel)
+	for item in pubsub.listen():
+		if item["type"] != "message":
+			continue
+		try:
+			change = json.loads(item["data"])
+			if change["worker"] != workerId:
+				applyChange(change)
+		except Exception as e:
+			print "couldn't apply change from another worker: " + str(e)
+
+if socketioQueue:
+	import redis
+	workerBus = redis.StrictRedis.from_url(socketioQueue)
+	gevent.spawn(listenForChanges)
+else:
+	workerBus = None
+	if int(os.environ.get('WEB_WORKERS', 1)) > 1:
+		print "warning: WEB_WORKERS is more than 1 but SOCKETIO_QUEUE isn't set, so the workers' caches and leaderboards will drift apart"
+
+# ----------- Snapshots --------------
+# Every snapshotInterval seconds (and at exit) the active game and all of its players are written out
+# as one zlib-compressed JSON blob. At startup, before any webhook is served, the blob is loaded into
+# the cache and the leaderboard ranking, so the first texts and leaderboard loads after a restart
+# don't each wait on Mongo. Mongo stays the source of truth: a background reconcile re-reads the game
+# and players and replaces whatever the snapshot got wrong (e.g. writes made after it was taken, or
+# players deleted since, which are dropped from the cache and the leaderboard), except for players
+# whose cached record changed while it was reading them, whose cached record is newer than what it
+# read. Points go through setScore, which keeps whichever is newer anyway.
+startupStats = {"snapshotPlayers": 0, "snapshotLoadMs": 0, "reconcileMs": 0, "firstResponseMs": 0}
+
+def takeSnapshot():
+	game = games.find_one({"status":"active"})
+	if not game:
+		return
+	game["_id"] = str(game["_id"])
+	blob = zlib.compress(json.dumps({"game": game, "players": list(players.find({}, {"_id":0}))}))
+	if snapshotFile:
+		# write and rename, so a crash mid-write can't leave a broken snapshot behind
+		with open(snapshotFile + ".tmp", "wb") as f:
+			f.write(blob)
+		os.rename(snapshotFile + ".tmp", snapshotFile)
+	else:
+		snapshots.replace_one({"_id": "active"}, {"_id": "active", "time": datetime.datetime.utcnow(), "blob": Binary(blob)}, upsert=True)
+
+def readSnapshot():
+	if snapshotFile:
+		if not os.path.exists(snapshotFile):
+			return None
+		with open(snapshotFile, "rb") as f:
+			return json.loads(zlib.decompress(f.read()))
+	snapshot = snapshots.find_one({"_id": "active"})
+	return snapshot and json.loads(zlib.decompress(snapshot["blob"]))
+
+def warmCache(game, gamePlayers):
+	cache["game"] = game
+	indexGame(game)
+	for player in gamePlayers:
+		cachePlayer(player)
+		setScore(player["agentNumber"], player["points"], player.get("scoreVersion", 0))
+	cache["ranking"] = sorted((-points, agentNumber) for agentNumber, points in cache["rankedPoints"].items())
+
+def loadSnapshot():
+	start = time.time()
+	try:
+		snapshot = readSnapshot()
+	except Exception as e:
+		print "couldn't read snapshot: " + str(e)
+		return
+	# (snapshots taken before they included the game's _id are left for the reconcile to replace)
+	if snapshot and "_id" in snapshot["game"]:
+		snapshot["game"]["_id"] = ObjectId(snapshot["game"]["_id"])
+		warmCache(snapshot["game"], snapshot["players"])
+		startupStats["snapshotPlayers"] = len(snapshot["players"])
+		startupStats["snapshotLoadMs"] = int((time.time() - start) * 1000)
+		gevent.spawn(reconcileSnapshot)
+
+def reconcileSnapshot():
+	start = time.time()
+	snapshotGame = cache["game"]
+	game = games.find_one({"status":"active"})
+	if not game or not snapshotGame or game["_id"] != snapshotGame["_id"]:
+		# the snapshot was of some other game
+		invalidateCache()
+		return
+	# (swapped in straight away, so that nothing written to the game from here on is lost)
+	cache["game"] = game
+	indexGame(game)
+	cache["touched"] = set()
+	try:
+		gamePlayers = list(players.find())
+	finally:
+		touched = cache["touched"]
+		cache["touched"] = None
+	for player in gamePlayers:
+		if player["agentNumber"] not in touched:
+			cachePlayer(player)
+		setScore(player["agentNumber"], player["points"], player.get("scoreVersion", 0))
+	# players the snapshot had that have since been deleted from Mongo
+	read = set(player["agentNumber"] for player in gamePlayers)
+	gone = [agentNumber for agentNumber in set(cache["byAgent"]) | set(cache["rankedPoints"]) if agentNumber not in read and agentNumber not in touched]
+	for agentNumber in gone:
+		uncachePlayer(agentNumber)
+		dropScore(agentNumber)
+	if gone:
+		emitMessage({"type": "refresh"})
+	startupStats["reconcileMs"] = int((time.time() - start) * 1000)
+
+def snapshotter():
+	while True:
+		gevent.sleep(snapshotInterval)
+		try:
+			takeSnapshot()
+		except Exception as e:
+			print "couldn't take snapshot: " + str(e)
+
+if snapshotInterval:
+	loadSnapshot()
+	gevent.spawn(snapshotter)
+	atexit.register(takeSnapshot)
+
 # --------- Auth? --------------
 def check_auth(username, pw):
     """This function is called to check if a username /
@@ -332,9 +1124,18 @@ def greet():
 def incomingSMS():
 	phoneNumber = request.form.get('From', None)
 	content = request.form.get('Body', None)
+	messageSid = request.form.get('MessageSid', None)
 	# socketio.emit('message', content)
+	if messageSid and not firstDelivery(messageSid):
+		# a retry of a message we've already handled (or are still handling)
+		return Response('', 204, {})
 	if phoneNumber and content:
-		gameLogic(phoneNumber = phoneNumber, rawcontent = content, language = english)
+		start = time.time()
+		kind = gameLogic(phoneNumber = phoneNumber, rawcontent = content, language = english)
+		recordTiming("gameLogic", time.time() - start, kind)
+		if not startupStats["firstResponseMs"]:
+			startupStats["firstResponseMs"] = int((time.time() - startedAt) * 1000)
+			print "first webhook answered %dms after startup" % startupStats["firstResponseMs"]
 		return Response('', 204, {})
 	else: 
 		return "Eh?"
@@ -363,16 +1164,51 @@ def incomingSMS():
 # 		return "Eh?"
 # ---- /multiple languages ----
 
+# ?top=N shows only the N highest-scoring agents
 @app.route('/leaderboard', methods=['GET'])
 def leaderboard():
-	spuriousList = lookup(games, "status", "active", "spuriousReports")
-	return render_template("leaderboard.html", players = players, spuriousReports = spuriousList)
+	spuriousList = getActiveGame()["spuriousReports"]
+	top = request.args.get('top', None, type=int)
+	return render_template("leaderboard.html", ranking = topAgents(top), top = top, spuriousReports = spuriousList)
+
+@app.route('/leaderboard/top/<int:n>', methods=['GET'])
+def leaderboardTop(n):
+	return jsonify(agents = [{"agentNumber": agentNumber, "points": points} for agentNumber, points in topAgents(n)])
+
+@app.route('/leaderboard/rank/<agentNumber>', methods=['GET'])
+def leaderboardRank(agentNumber):
+	return jsonify(agentNumber = agentNumber, rank = getRank(agentNumber), points = cache["rankedPoints"].get(agentNumber))
 
 
 @app.route('/leatranscript', methods=['GET'])
 @requires_auth
 def showtranscript():
-		return render_template("transcript.html", information = transcripts)
+	tag = request.args.get('tag') or None
+	agent = request.args.get('agent') or None
+	# (a limit of 0 would mean no limit to Mongo, and a negative one a single batch)
+	limit = max(1, min(request.args.get('limit', transcriptPageSize, type=int), 5000))
+	try:
+		before = ObjectId(request.args['before']) if request.args.get('before') else None
+		after = ObjectId(request.args['after']) if request.args.get('after') else None
+	except InvalidId:
+		return Response('Bad page cursor.', 400, {})
+	entries = transcriptPage(tag, agent, before, after, limit)
+	# both formats are streamed, so the first lines go out before the last ones are read from Mongo
+	if request.args.get('format') == "ndjson":
+		def lines():
+			for entry in entries:
+				yield json.dumps({"id": str(entry["_id"]), "time": str(entry["time"]), "tag": entry["tag"], "content": entry["content"]}) + "\n"
+		return Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+	# the latest page keeps going with lines from the socket
+	live = not before and not after
+	return Response(stream_with_context(streamTemplate("transcript.html", entries = entries, tag = tag, agent = agent, limit = limit, live = live)))
+
+# render_template, but yielding the page in pieces as the template gets through its loops
+def streamTemplate(templateName, **context):
+	app.update_template_context(context)
+	stream = app.jinja_env.get_template(templateName).stream(context)
+	stream.enable_buffering(20)
+	return stream
 
 @app.route('/leaconsole', methods=['GET'])
 @requires_auth
@@ -394,8 +1230,11 @@ def PM():
 
 @app.route('/leaconsole/refreshwordlist', methods=['GET'])
 def refresh():
-	socketio.emit("message", {"type": "refresh"})
-	return "Refreshed.<br><a href=\"/leaconsole\">go back</a>"
+	# wordlists and player records may have been edited directly in Mongo, so start the cache over
+	invalidateCache()
+	publishChange({"type": "invalidate"})
+	emitMessage({"type": "refresh"})
+	return "Refreshed. (cache had "+str(cacheStats["hits"])+" hits, "+str(cacheStats["misses"])+" misses)<br><a href=\"/leaconsole\">go back</a>"
 
 @app.route('/leaconsole/broadcast', methods=['POST'])
 def broadcast():
@@ -403,22 +1242,28 @@ def broadcast():
 	if (pw == password):
 		content = request.form.get('Body', None)
 		fromNumber = twilioNumbers[0]
-		numberofAgents = 0
-		activeAgents = players.find({"status" : "active"})
-		for agent in activeAgents:
-			numberofAgents = numberofAgents + 1
-		 	if not debug:
-				try:
-					message = twilioclient.sms.messages.create(body=content, to=agent.phoneNumber, from_=fromNumber)
-			 	except twilio.TwilioRestException as e:
-					content = content + " WITH TWILIO ERROR: " + str(e)
-			 	except:
-			 		print "some sort of twilio error"
-		transcript(content="Broadcast message to "+str(numberofAgents)+" active agents: "+content, tag="broadcast")
-		return "Broadcast \'"+content+"\' to "+str(numberofAgents)+" active agents.<br><a href=\"/leaconsole\">go back</a>"
+		waiting = broadcasts.qsize()
+		broadcasts.put((content, fromNumber))
+		return "Queued broadcast \'"+content+"\' to all active agents ("+str(waiting)+" broadcasts ahead of it). Progress shows on the console.<br><a href=\"/leaconsole\">go back</a>"
 	else:
 		return "Incorrect password.<br><a href=\"/leaconsole\">go back</a>"
 
+@app.route('/leaconsole/metrics', methods=['GET'])
+@requires_auth
+def metrics():
+	return Response(metricsText(), 200, {"Content-Type": "text/plain; version=0.0.4"})
+
+# ?action=start or ?action=stop; either way, shows what's been sampled so far
+@app.route('/leaconsole/profile', methods=['GET'])
+@requires_auth
+def profile():
+	action = request.args.get('action', None)
+	if action == "start":
+		startProfiler()
+	elif action == "stop":
+		stopProfiler()
+	return Response(profileReport(), 200, {"Content-Type": "text/plain"})
+
 @app.route('/sockettest', methods=['GET'])
 def testThoseSockets():
         return render_template("sockettest.html")
@@ -429,9 +1274,16 @@ def testThoseSockets():
 # 	socketio.emit('message', "hello from a get request")
 # 	return "success"
 
+# Pages join the room for the messages they show once they connect (and again after reconnecting)
+@socketio.on('join')
+def joinRoom(room):
+	if room in pendingEmits:
+		join_room(room)
+
+# /sockettest's ping. Only the page that sent it gets the reply: other pages only get their rooms' frames.
 @socketio.on('message')
 def handle_source():
-	socketio.emit('message', "hello from a socket event")
+	emit('message', "hello from a socket event")
 
 
 #----------Jinja filter-------------------------------------------
@@ -0,0 +1,72 @@
+# Moves the report lists out of player records and into the reports collection (see recordReport in
+# makenight.py), leaving counts behind on the players.
+#
+#   python migratereports.py            migrates every player in MONGOHQ_URL that still has the lists
+#   python migratereports.py --dry-run  just says what it would do
+#
+# Safe to run more than once, and on a live game: players that are already migrated are skipped, and
+# report documents are upserted. The reports are filed under the active game (or the latest one, if
+# none is active). Hit /leaconsole/refreshwordlist afterwards so running workers reload their cached
+# players.
+import argparse
+import os
+from collections import Counter
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
+import collectionnames
+
+parser = argparse.ArgumentParser(description="Move players' report lists into the reports collection")
+parser.add_argument("--dry-run", action="store_true", help="count what would be migrated without writing")
+args = parser.parse_args()
+
+mongoclientURL = os.environ['MONGOHQ_URL']
+database = MongoClient(mongoclientURL)[mongoclientURL.split("/")[-1]]
+players = database[collectionnames.players]
+reports = database[collectionnames.reports]
+games = database[collectionnames.games]
+game = games.find_one({"status": "active"}) or games.find_one(sort=[("_id", DESCENDING)])
+if not game:
+	raise SystemExit("No game to file the reports under.")
+if not args.dry_run:
+	# the first version of the reports index didn't include the game, so it would keep reports unique across games
+	if "reporter_1_target_1_word_1_kind_1" in reports.index_information():
+		reports.drop_index("reporter_1_target_1_word_1_kind_1")
+	reports.create_index([("game", ASCENDING), ("reporter", ASCENDING), ("target", ASCENDING), ("word", ASCENDING), ("kind", ASCENDING)], unique=True)
+
+# The old lists held "agent word" strings
+def split(entry):
+	target, _, word = entry.partition(" ")
+	return target, word
+
+def reportKey(kind, reporter, target, word=""):
+	return {"game":game["_id"], "reporter":reporter, "target":target, "word":word, "kind":kind}
+
+migrated = 0
+written = 0
+for player in players.find({"successfulContacts": {"$exists": True}}):
+	agentNumber = player["agentNumber"]
+	contacts = player.get("successfulContacts", [])
+	enemyCodes = player.get("reportedEnemyCodes", [])
+	spurious = player.get("spuriousReports", [])
+	writes = []
+	for friend in contacts:
+		# both agents listed the contact; filing it under the lower number makes the two one report
+		key = reportKey("contact", min(agentNumber, friend), max(agentNumber, friend))
+		writes.append(UpdateOne(key, {"$setOnInsert": key}, upsert=True))
+	for entry in enemyCodes:
+		key = reportKey("enemy", agentNumber, *split(entry))
+		writes.append(UpdateOne(key, {"$setOnInsert": key}, upsert=True))
+	for (target, word), count in Counter(split(entry) for entry in spurious).items():
+		writes.append(UpdateOne(reportKey("spurious", agentNumber, target, word), {"$set": {"count": count}}, upsert=True))
+	# interceptedTransmits only mirrored the reporters' reportedEnemyCodes, so it just becomes a count
+	counters = {"contacts": len(contacts), "enemyReports": len(enemyCodes),
+		"intercepted": len(player.get("interceptedTransmits", [])), "spurious": len(spurious)}
+	migrated += 1
+	written += len(writes)
+	if args.dry_run:
+		continue
+	if writes:
+		reports.bulk_write(writes, ordered=False)
+	players.update_one({"_id": player["_id"]}, {"$set": counters,
+		"$unset": {"successfulContacts": "", "interceptedTransmits": "", "reportedEnemyCodes": "", "spuriousReports": ""}})
+
+print "%s %d players, %d report writes." % ("Would migrate" if args.dry_run else "Migrated", migrated, written)
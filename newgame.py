@@ -0,0 +1,31 @@
+# Sets up a new game from a file of words (separated by whitespace or punctuation).
+#
+#   python newgame.py words.txt 6 40            prints the games document as JSON
+#   python newgame.py words.txt 6 40 --insert   retires the active game and makes this one active
+#
+# --insert uses the database in MONGOHQ_URL. Hit /leaconsole/refreshwordlist afterwards so the
+# running app picks the new game up.
+import argparse
+import json
+import os
+import listprep
+import collectionnames
+
+parser = argparse.ArgumentParser(description="Make a new game's wordlists")
+parser.add_argument("wordfile")
+parser.add_argument("groupSize", type=int, help="words per wordlist")
+parser.add_argument("numberOfGroups", type=int, help="number of wordlists (teams)")
+parser.add_argument("--insert", action="store_true", help="make it the active game in MONGOHQ_URL")
+args = parser.parse_args()
+
+game = listprep.makeGame(open(args.wordfile).read(), args.groupSize, args.numberOfGroups)
+
+if args.insert:
+	from pymongo import MongoClient
+	mongoclientURL = os.environ['MONGOHQ_URL']
+	games = MongoClient(mongoclientURL)[mongoclientURL.split("/")[-1]][collectionnames.games]
+	games.update_many({"status":"active"}, {"$set":{"status":"finished"}})
+	games.insert_one(game)
+	print "Inserted a game with %d wordlists of %d words." % (args.numberOfGroups, args.groupSize)
+else:
+	print json.dumps(game, indent=1)
@@ -0,0 +1,55 @@
+# Turns the body of an incoming text into a command, in one pass over the message.
+# The rules are the ones gameLogic has always used:
+# - from an unknown phone, the first word is the agent number they want to join as
+# - "leaving" at the start of the message retires the agent
+# - a single word that looks like an agent number reports friendly contact with that agent
+# - an agent number plus exactly one other word reports that agent for using that word
+# - anything else is Invalid, with a reason saying why
+import re
+import string
+from collections import namedtuple
+
+Join = namedtuple("Join", ["agentNumber"])
+Leave = namedtuple("Leave", [])
+Friend = namedtuple("Friend", ["agentNumber"])
+Enemy = namedtuple("Enemy", ["agentNumber", "word"])
+# reason is "notanagentnumber" (joining), "toomanywords" or "unparseable"
+Invalid = namedtuple("Invalid", ["reason"])
+
+# (no re.UNICODE: accented letters count as separators, as they always have)
+separators = re.compile('\W+')
+agentNumberPattern = re.compile('\d{2,3}')
+leavingPattern = re.compile('leaving')
+punctuation = string.punctuation
+
+def isAgentNumber(word):
+	return agentNumberPattern.match(word)
+
+# Lowercase words of the message, split on whitespace and punctuation
+def tokenize(rawcontent):
+	return separators.split(rawcontent.strip().lower().strip(punctuation))
+
+# A message from a phone we don't know yet
+def parseJoin(rawcontent):
+	agentNumber = separators.split(rawcontent.lower(), 1)[0]
+	if isAgentNumber(agentNumber):
+		return Join(agentNumber)
+	return Invalid("notanagentnumber")
+
+# A message from a known agent
+def parse(rawcontent):
+	lowered = rawcontent.lower()
+	if leavingPattern.match(lowered):
+		return Leave()
+	content = separators.split(lowered.strip().strip(punctuation))
+	if len(content) == 1:
+		if isAgentNumber(content[0]):
+			return Friend(content[0])
+		return Invalid("unparseable")
+	# the first word that looks like an agent number is the accused; the rest should be one suspicious word
+	for i, word in enumerate(content):
+		if isAgentNumber(word):
+			if len(content) == 2:
+				return Enemy(word, content[1 - i])
+			return Invalid("toomanywords")
+	return Invalid("unparseable")